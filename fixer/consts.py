@@ -5,16 +5,6 @@ from loguru import logger
 from enum import Enum
 
 
-class SystemStatus(Enum):
-    HALT = 0
-    PREPARE = 1
-    WORKING = 2
-    SHUTDOWN_START = 3
-    AFTER_SHUTDOWN_FIXER_PROCESS = 4
-    AFTER_SHUTDOWN_DB = 5
-    AFTER_SHUTDOWN_LOG = 6
-
-
 class WorkingStatus(Enum):
     BEFORE_PROCESS = 0
     CAN_NOT_PREPARED_UPLOAD_USER_FOLDER = 1
@@ -23,11 +13,15 @@ class WorkingStatus(Enum):
     FILE_ALREADY_EXIST_WHEN_FILE_COPY = 4
     CAN_NOT_COPY = 5
     CAN_NOT_REMOVE_COLLABORATION = 6
+    COLLABORATED = 10
+    COPIED = 20
     COMPLETE = 100
 
 
 APP_USER_TABLENAME = "APP_USERS"
 FIX_LIST_TABLENAME = "FIX_LIST"
+FOLDER_INDEX_TABLENAME = "FOLDER_INDEX"
+IMPORT_CSV_STATE_TABLENAME = "IMPORT_CSV_STATE"
 
 TABLE_SCHEMAS = {
     APP_USER_TABLENAME: {
@@ -117,6 +111,38 @@ TABLE_SCHEMAS = {
                 'struct': dataset.database.Types.text,
                 'constraints': {'nullable': True, }
             },
+            'lease_owner': {
+                'struct': dataset.database.Types.text,
+                'constraints': {'nullable': True, }
+            },
+            'lease_run_id': {
+                'struct': dataset.database.Types.text,
+                'constraints': {'nullable': True, }
+            },
+            'lease_expires_at': {
+                'struct': dataset.database.Types.datetime,
+                'constraints': {'nullable': True, }
+            },
+            'collaboration_id': {
+                'struct': dataset.database.Types.text,
+                'constraints': {'nullable': True, }
+            },
+            'collaborate_attempt_count': {
+                'struct': dataset.database.Types.integer,
+                'constraints': {'nullable': True, }
+            },
+            'copy_attempt_count': {
+                'struct': dataset.database.Types.integer,
+                'constraints': {'nullable': True, }
+            },
+            'remove_collaboration_attempt_count': {
+                'struct': dataset.database.Types.integer,
+                'constraints': {'nullable': True, }
+            },
+            'next_attempt_at': {
+                'struct': dataset.database.Types.datetime,
+                'constraints': {'nullable': True, }
+            },
 
             'created_at': {
                 'struct': dataset.database.Types.datetime,
@@ -126,8 +152,87 @@ TABLE_SCHEMAS = {
                 'struct': dataset.database.Types.datetime,
                 'constraints': {'nullable': False, }
             }
-        }
-    }
+        },
+        'indexes': {
+            'ix_fix_list_restored_file_id_upload_user_id': {
+                'columns': ['restored_file_id', 'upload_user_id'],
+            },
+            'ix_fix_list_uploader_email': {
+                'columns': ['uploader_email'],
+            },
+            # Partial indexes hold only the rows the fixer still looks for.
+            'ix_fix_list_unfinished': {
+                'columns': ['id'],
+                'where': f'working_status != {WorkingStatus.COMPLETE.value}',
+            },
+            'ix_fix_list_next_attempt_at': {
+                'columns': ['next_attempt_at'],
+                'where': 'next_attempt_at IS NOT NULL',
+            },
+        },
+    },
+
+    # (root folder, uploader, owner) -> Box folder ID shared by all fixer
+    # processes. owner_login is '' for the upload_user folder itself.
+    FOLDER_INDEX_TABLENAME: {
+        'primary_id': 'id',
+        'columns': {
+            'root_folder_id': {
+                'struct': dataset.database.Types.text,
+                'constraints': {'nullable': False, }
+            },
+            'uploader_email': {
+                'struct': dataset.database.Types.text,
+                'constraints': {'nullable': False, }
+            },
+            'owner_login': {
+                'struct': dataset.database.Types.text,
+                'constraints': {'nullable': False, }
+            },
+            'folder_id': {
+                'struct': dataset.database.Types.text,
+                'constraints': {'nullable': False, }
+            },
+        },
+        'indexes': {
+            'ix_folder_index_key': {
+                'columns': ['root_folder_id', 'uploader_email', 'owner_login'],
+                'unique': True,
+            },
+        },
+    },
+
+    # How far import-csv got in each CSV file, so that rows appended to it
+    # later are imported without reading the file again.
+    IMPORT_CSV_STATE_TABLENAME: {
+        'primary_id': 'id',
+        'columns': {
+            'csv_path': {
+                'struct': dataset.database.Types.text,
+                'constraints': {'nullable': False, }
+            },
+            'file_identity': {
+                'struct': dataset.database.Types.text,
+                'constraints': {'nullable': False, }
+            },
+            'prefix_checksum': {
+                'struct': dataset.database.Types.text,
+                'constraints': {'nullable': False, }
+            },
+            'byte_offset': {
+                'struct': dataset.database.Types.bigint,
+                'constraints': {'nullable': False, }
+            },
+            'row_count': {
+                'struct': dataset.database.Types.integer,
+                'constraints': {'nullable': False, }
+            },
+            'updated_at': {
+                'struct': dataset.database.Types.datetime,
+                'constraints': {'nullable': False, }
+            },
+        },
+    },
 }
 
 
@@ -143,11 +248,53 @@ REQUIRED_CSV_COLUMNS = (
 FIX_PROCESS_RETRY_COUNT = 10
 FIX_PROCESS_RETRY_WAIT_TIME = 3
 FIX_PROCESS_DB_RETRY_COUNT = 10
+FIX_CLAIM_BATCH_SIZE = 10
+FIX_LEASE_SEC = 60 * 30
+DB_BUSY_TIMEOUT_SEC = 30
+DB_BATCH_SIZE = 500
+DB_BATCH_WAIT_TIME = 0.1
+IMPORT_CSV_CHUNK_SIZE = 10000
+IMPORT_CSV_PARSE_CHUNK_BYTES = 1024 * 1024 * 32
+IMPORT_CSV_SCAN_BLOCK_BYTES = 1024 * 1024
+IMPORT_CSV_CHECKSUM_BYTES = 1024 * 1024
+HTTP_POOL_SIZE = 10
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL_SEC = 60 * 10
+FOLDER_INDEX_CACHE_SIZE = 100000
+FOLDER_LOCK_STRIPES = 64
+RATE_LIMIT_PER_SEC = 100
+RATE_LIMIT_BURST = 100
+RATE_LIMIT_PER_USER_PER_SEC = 16
+RATE_LIMIT_PER_USER_BURST = 16
+RATE_LIMIT_USER_STRIPES = 256
+
+# Fields requested per Box call site. Box leaves everything else out of
+# the response.
+BOX_FIELDS = {
+    "folder_items": ("id", "name", "type"),
+    "collaborations": ("id", "type", "accessible_by"),
+    "collaborate": ("id", "type"),
+    "folder": ("id", "type"),
+    "user": ("id", "type", "name", "login"),
+}
+BOX_LIST_LIMIT = 1000
 
 FIX_PROCESS_WAIT_FOR_COLLABORATE_TIME = 3
-PROCESS_BASIC_WAIT_TIME = 0.01
-SHUTDOWN_BASIC_WAIT_TIME = 1.0
+FIX_PROCESS_MAX_WAIT_TIME = 60 * 5
+FIX_ENGINES = ("process", "async")
+FIX_PIPELINE_STAGES = ("resolve", "collaborate", "copy",
+                       "remove_collaboration", "record")
+# Every Box call of the async engine runs on a thread, so this bounds the
+# threads per pipeline stage per process.
+FIX_PIPELINE_MAX_CONCURRENCY = 100
+FIX_PIPELINE_QUEUE_SIZE_PER_WORKER = 2
+FIX_PIPELINE_IDLE_WAIT_TIME = 1
+FIX_PIPELINE_REPORT_INTERVAL_SEC = 60
+PROCESS_SHUTDOWN_SENTINEL = None
 NEXT_REFRESH_ACCESS_TOKEN_SEC = 60 * 45
+ACCESS_TOKEN_ISSUE_CONCURRENCY = 8
+ACCESS_TOKEN_RETRY_WAIT_TIME = 10
+ACCESS_TOKEN_RETRY_MAX_WAIT_TIME = 60 * 5
 
 WEBSERVER_RETRY_COUNT = 10
 WEBSERVER_RETRY_WAIT_TIME = 1
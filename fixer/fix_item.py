@@ -0,0 +1,45 @@
+class FixItem:
+    # The FIX_LIST columns the fixer reads, nothing else. Lookups work like
+    # the dataset row it replaces, so fix_data["login"] and
+    # fix_data.get("copy_file_id") keep working.
+    __slots__ = (
+        "id",
+        "restored_file_id",
+        "file_name",
+        "user_id",
+        "login",
+        "uploader_email",
+        "working_status",
+        "copy_file_id",
+        "collaboration_id",
+        "collaborate_attempt_count",
+        "copy_attempt_count",
+        "remove_collaboration_attempt_count",
+    )
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*[row.get(name) for name in cls.__slots__])
+
+    @classmethod
+    def get_columns(cls, table):
+        return [table.c[name] for name in cls.__slots__]
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return f"FixItem({', '.join(f'{name}={value!r}' for name, value in zip(self.__slots__, self))})"
@@ -6,20 +6,20 @@
 
 Usage:
   fixer initialize-db  <DATABASE-FILE> [-o|--optcheck-only] [-h|--help]
-  fixer import-csv <DATABASE-FILE> <CSV-FILE> [-o|--optcheck-only] [-h|--help]
+  fixer import-csv <DATABASE-FILE> <CSV-FILE> [--workers=<WORKERS>] [-o|--optcheck-only] [-h|--help]
   fixer create-appuser <DATABASE-FILE> <JWT-FILE> [--create-appuser-num=<CREATE-APPUSER-NUM>] [-o|--optcheck-only] [-h|--help]
   fixer delete-appuser <DATABASE-FILE> <JWT-FILE> <BOX-USER-ID> [-o|--optcheck-only] [-h|--help]
   fixer initialize-service-account-directory <DATABASE-FILE> <JWT-FILE> [-o|--optcheck-only] [-h|--help]
   fixer show-appuser-list <DATABASE-FILE>[-o|--optcheck-only] [-h|--help]
   fixer show-service-account-info <JWT-FILE> [-o|--optcheck-only] [-h|--help]
-  fixer fix <DATABASE-FILE> <JWT-FILE> <BOX-FOLDER-ID> [--process=<PROCESS-NUM>] [--box-file-url=<BOX-URL>] [-o|--optcheck-only] [-h|--help]
+  fixer fix <DATABASE-FILE> <JWT-FILE> <BOX-FOLDER-ID> [--process=<PROCESS-NUM>] [--engine=<ENGINE>] [--concurrency=<CONCURRENCY>] [--stage-concurrency=<STAGE-CONCURRENCY>] [--copy-first] [--box-file-url=<BOX-URL>] [-o|--optcheck-only] [-h|--help]
   fixer collaborate-and-put-csv <DATABASE-FILE> <JWT-FILE> <BOX-FOLDER-ID> [--skip-collaboration] [--skip-put-csv][-o|--optcheck-only][-h --help]
   fixer start-webserver <JWT-FILE> [--cert=<CERT-FILE>] [--private-key=<PRIVATE-KEY-FILE>] [--port=<PORT-NUM>] [-o|--optcheck-only] [-h|--help]
   fixer emergency-remove-collaborations <JWT-FILE> <BOX-FOLDER-ID> [-o|--optcheck-only][-h --help]
 
 
 Options:
-  CSV                                                 CSV File
+  CSV                                                 CSV File, may be gzip, bz2 or xz. - reads stdin
   JWT-File                                            JWT File
   <DATABASE-FILE>                                     DATABASE File
   <BOX-USER-ID>                                       BOX-USER-ID
@@ -27,6 +27,11 @@ Options:
   --create-appuser-num=<CREATE-APPUSER-NUM            Create App User Number [default: 1]
   --box-file-url=<BOX-FILE-URL>                       Base box file url [default: https://app.box.com/file/]
   --process=<PROCESS-NUM>                             Number of Process [default: 1]
+  --engine=<ENGINE>                                   Fix engine. process or async [default: process]
+  --concurrency=<CONCURRENCY>                         Number of threads per pipeline stage per process, at most 100 (async engine) [default: 10]
+  --stage-concurrency=<STAGE-CONCURRENCY>             Threads of single stages, e.g. copy=20,collaborate=5 (async engine)
+  --copy-first                                        Try the copy before collaborating, collaborate only on 403/404
+  --workers=<WORKERS>                                 Number of CSV parsing processes (import-csv) [default: 1]
   --skip-collaboration                                Skip Collaborate to uploader_user
   --skip-put-csv                                      Skip Upload CSV
   --port=<PORT-NUM>                                   Web server port [default: 8080]
@@ -0,0 +1,66 @@
+import consts
+import utils
+from sqlalchemy.dialects.sqlite import insert
+
+# In-process read-through cache in front of the FOLDER_INDEX table.
+# Folder IDs never change once created, so entries do not expire.
+_folder_id_cache = utils.TTLCache(consts.FOLDER_INDEX_CACHE_SIZE)
+
+
+def clear_cache():
+    _folder_id_cache.clear()
+
+
+def get_folder_id(db, root_folder_id, uploader_email, owner_login=""):
+    cache_key = (str(root_folder_id), uploader_email, owner_login)
+    if folder_id := _folder_id_cache.get(cache_key):
+        return folder_id
+
+    row = db[consts.FOLDER_INDEX_TABLENAME].find_one(
+        root_folder_id=str(root_folder_id),
+        uploader_email=uploader_email,
+        owner_login=owner_login,
+    )
+    if not row:
+        return None
+
+    _folder_id_cache.set(cache_key, row["folder_id"])
+    return row["folder_id"]
+
+
+def put_folder_id(db, root_folder_id, uploader_email, owner_login, folder_id):
+    put_folder_id_list(
+        db, [(root_folder_id, uploader_email, owner_login, folder_id)])
+
+
+def put_folder_id_list(db, folder_list):
+    if not folder_list:
+        return
+
+    # On the unique key, so that processes listing the same folder at the
+    # same time update the row instead of inserting it twice.
+    table = db[consts.FOLDER_INDEX_TABLENAME].table
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=["root_folder_id", "uploader_email", "owner_login"],
+        set_={"folder_id": statement.excluded.folder_id})
+    with db:
+        db.executable.execute(statement, [{
+            "root_folder_id": str(root_folder_id),
+            "uploader_email": uploader_email,
+            "owner_login": owner_login,
+            "folder_id": str(folder_id),
+        } for root_folder_id, uploader_email, owner_login, folder_id in folder_list])
+
+    for root_folder_id, uploader_email, owner_login, folder_id in folder_list:
+        _folder_id_cache.set(
+            (str(root_folder_id), uploader_email, owner_login), str(folder_id))
+
+
+def evict_folder_id(root_folder_id, uploader_email, owner_login=""):
+    _folder_id_cache.pop((str(root_folder_id), uploader_email, owner_login))
+
+
+def has_root_folder(db, root_folder_id):
+    return db[consts.FOLDER_INDEX_TABLENAME].count(
+        root_folder_id=str(root_folder_id)) > 0
@@ -41,7 +41,7 @@ def main(opt):
     db = utils.get_db(opt)
 
     user_folder_cache = dict()
-    for item in service_client.folder(opt["<BOX-FOLDER-ID>"]).get_items():
+    for item in utils.get_folder_items(service_client.folder(opt["<BOX-FOLDER-ID>"])):
         if item.type != "folder":
             continue
         user_folder_cache[item.name] = {"folder_id": item.id}
@@ -71,7 +71,7 @@ def main(opt):
 
                 success_flg = False
                 for i in range(1, 10 + 1):
-                    exist_file_id = None
+                    exist_file = None
 
                     try:
                         service_client.folder(
@@ -83,15 +83,15 @@ def main(opt):
 
                     except Exception as e:
                         if hasattr(e, "context_info"):
-                            exist_file_id = e.context_info["conflicts"]["id"]
+                            exist_file = utils.get_conflict(
+                                service_client, e)
                         else:
                             logger.error(
                                 f"⚠ Can't upload csv file to {folder_and_uploader_email_name}. Retry({i}) Error: {e}")
                             continue
 
                     try:
-                        service_client.file(
-                            exist_file_id).update_contents_with_stream(fh)
+                        exist_file.update_contents_with_stream(fh)
                         logger.info(
                             f"⬆ Update csv file to {folder_and_uploader_email_name}.")
                         success_flg = True
@@ -5,6 +5,7 @@ from logging.handlers import QueueHandler, QueueListener
 from multiprocessing import Manager, Pool, get_logger
 
 import consts
+import rate_limiter
 import utils
 
 
@@ -16,8 +17,8 @@ def remove_collaboration(args):
 
     for i in range(1, consts.EMERGENCY_REMOVE_COLLABORATION_RETRY_COUNT + 1):
         try:
-            collaboration_list = service_client.folder(
-                folder_id).get_collaborations()
+            collaboration_list = utils.get_collaborations(
+                service_client.folder(folder_id))
             success_flg = True
             break
         except Exception as e:
@@ -51,12 +52,13 @@ def remove_collaboration(args):
 
 
 def main(opt):
+    rate_limiter.init()
     access_token = utils.get_auth(opt).authenticate_instance()
     service_client = utils.get_client(opt)
 
     folder_id_list = list()
     try:
-        for item in service_client.folder(opt["<BOX-FOLDER-ID>"]).get_items():
+        for item in utils.get_folder_items(service_client.folder(opt["<BOX-FOLDER-ID>"])):
             if not item.type == "folder":
                 continue
             folder_id_list.append(item.id)
@@ -1,3 +1,5 @@
+import asyncio
+import heapq
 import logging
 import queue
 import random
@@ -6,18 +8,26 @@ import sys
 import time
 import uuid
 import warnings
-from datetime import datetime
-from multiprocessing import Manager, Process
+import zlib
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from multiprocessing import Event, Lock, Manager, Process, Queue
 
 import consts
+import folder_index
+import rate_limiter
 import utils
 from boxsdk.exception import BoxAPIException
 from boxsdk.object.collaboration import CollaborationRole
 from dateutil.relativedelta import relativedelta
 from loguru import logger
+from sqlalchemy import and_, bindparam, or_, select
+from fix_item import FixItem
+from token_manager import TokenManager
 
 
-def true_gen(system_status):
+def true_gen(shutdown_event):
     # It exists for unit testing. See test_fix.py, etc. for details.
     while True:
         yield True
@@ -34,7 +44,7 @@ def log_operation(data):
     log_func(data['msg'])
 
 
-def log_process_func(system_status, log_queue):
+def log_process_func(log_queue):
     import sys
     logger.remove()
     logger.add('./logs/fixer.log',
@@ -43,59 +53,33 @@ def log_process_func(system_status, log_queue):
 
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-    wg = true_gen(system_status)
-    while wg.__next__():
-        time.sleep(consts.PROCESS_BASIC_WAIT_TIME)
-        if system_status.value == consts.SystemStatus.AFTER_SHUTDOWN_DB.value:
-            break
-        try:
-            data = log_queue.get_nowait()
-            log_operation(data)
-        except queue.Empty as e:
-            pass
-
-    time.sleep(3)
-    while not log_queue.empty():
-        data = log_queue.get_nowait()
+    # Block until the next message. main() puts PROCESS_SHUTDOWN_SENTINEL
+    # after every other process has been joined.
+    while (data := log_queue.get()) is not consts.PROCESS_SHUTDOWN_SENTINEL:
         log_operation(data)
 
 # -----------------------------------------------------------------------------
 
 
-def get_appuser_access_token_operation(opt,
-                                       log_queue,
-                                       appuser_list,
-                                       access_token_dict,
-                                       access_token_dict_lock):
-    with access_token_dict_lock:
-        def _get_and_store_fresh_appuser_access_token(box_user_id):
-            access_token = utils.get_appuesr_token(opt, box_user_id)
-            access_token_dict[access_token] = {
-                "retrieve_datetime": datetime.now(),
-                "box_user_id": box_user_id,
-            }
-            return access_token
-
-        if len(access_token_dict) <= 0:
-            put_log(
-                log_queue, f'Obtain access tokens for all Appusers for initial startup.', level=logging.INFO)
-            for appuser in appuser_list:
-                _ = _get_and_store_fresh_appuser_access_token(
-                    appuser["box_user_id"])
+def token_process_func(token_manager, shutdown_event, log_queue):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    put_log(
+        log_queue, f'Obtain access tokens for all Appusers for initial startup.', level=logging.INFO)
+
+    while True:
+        for box_user_id, e in token_manager.issue_all(
+                token_manager.get_refresh_list()).items():
+            if e:
                 put_log(
-                    log_queue, f"{appuser['login']}'s access token has been obtained.", level=logging.INFO)
-
-        access_token = random.choice([t for t in access_token_dict.keys()])
-        if datetime.now() > access_token_dict[access_token]["retrieve_datetime"] + \
-                relativedelta(seconds=consts.NEXT_REFRESH_ACCESS_TOKEN_SEC):
-            box_user_id = access_token_dict[access_token]["box_user_id"]
-            del (access_token_dict[access_token])
-            access_token = _get_and_store_fresh_appuser_access_token(
-                box_user_id)
-            put_log(
-                log_queue, f'Appuser({box_user_id}) access token is about to expire. A new one will be issued.', level=logging.INFO)
+                    log_queue, f"Can't obtain Appuser({box_user_id}) access token!: {e}", level=logging.ERROR)
+            else:
+                put_log(
+                    log_queue, f"Appuser({box_user_id}) access token has been obtained.", level=logging.INFO)
+        token_manager.ready_event.set()
 
-    return access_token, access_token_dict[access_token]["box_user_id"]
+        # Refresh each token before it expires, while workers keep using it.
+        if shutdown_event.wait(token_manager.get_next_refresh_wait_time()):
+            break
 
 # -----------------------------------------------------------------------------
 
@@ -120,26 +104,135 @@ def db_operation(db, data, log_queue):
         put_log(log_queue, f'Database operation error: {err}', logging.ERROR)
 
 
-def db_process_func(system_status, opt, db_queue, log_queue):
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
-    db = utils.get_db(opt)
-    wg = true_gen(system_status)
+def get_update_signature(data):
+    if data.get("command") != "update" or data.get("kwargs"):
+        return None
+
+    args = data.get("args", list())
+    if len(args) != 2:
+        return None
+
+    row, keys = args
+    return (data["table_name"], tuple(keys), tuple(row.keys()))
 
-    while wg.__next__():
 
-        if system_status.value == consts.SystemStatus.PREPARE.value:
-            time.sleep(consts.PROCESS_BASIC_WAIT_TIME)
+def group_db_commands(data_list):
+    # Same-shaped updates are grouped for executemany. A row updated with a
+    # different shape, or any other command, closes the open groups so that
+    # per-row ordering is kept.
+    command_groups = list()
+    open_groups = dict()
+    row_signatures = dict()
+
+    for data in data_list:
+        signature = get_update_signature(data)
+        if signature is None:
+            command_groups.append([data])
+            open_groups.clear()
+            row_signatures.clear()
             continue
 
-        if system_status.value == consts.SystemStatus.AFTER_SHUTDOWN_FIXER_PROCESS.value:
-            break
+        row, keys = data["args"]
+        row_key = (data["table_name"], tuple(row[k] for k in keys))
+        if row_signatures.get(row_key, signature) != signature:
+            open_groups.clear()
+            row_signatures.clear()
 
-        try:
-            data = db_queue.get_nowait()
+        if signature not in open_groups:
+            open_groups[signature] = list()
+            command_groups.append(open_groups[signature])
+
+        open_groups[signature].append(data)
+        row_signatures[row_key] = signature
+
+    return command_groups
+
+
+def execute_many_update(db, data_list):
+    table_name, keys, columns = get_update_signature(data_list[0])
+    table = db[table_name].table
+
+    stmt = table.update().where(
+        and_(*[table.c[k] == bindparam(f"key_{k}") for k in keys])
+    ).values({c: bindparam(f"value_{c}") for c in columns})
+
+    params = list()
+    for data in data_list:
+        row = data["args"][0]
+        param = {f"key_{k}": row[k] for k in keys}
+        param.update({f"value_{c}": row[c] for c in columns})
+        params.append(param)
+
+    db.executable.execute(stmt, params)
+
+
+def db_batch_operation(db, data_list, log_queue):
+    start = time.perf_counter()
+    try:
+        db.begin()
+        for command_group in group_db_commands(data_list):
+            if len(command_group) > 1:
+                execute_many_update(db, command_group)
+                continue
+
+            data = command_group[0]
+            db_func = getattr(db[data['table_name']], data['command'])
+            db_func(*data.get('args', list()), **data.get('kwargs', dict()))
+
+        commit_start = time.perf_counter()
+        db.commit()
+
+    except Exception as err:
+        db.rollback()
+        put_log(
+            log_queue, f'Database batch operation error: {err}. Apply one by one.', logging.WARNING)
+        for data in data_list:
             db_operation(db, data, log_queue)
+        return
+
+    end = time.perf_counter()
+    put_log(
+        log_queue,
+        f'Database batch committed. size: {len(data_list)}, '
+        f'apply: {(commit_start - start) * 1000:.1f}ms, commit: {(end - commit_start) * 1000:.1f}ms',
+        logging.DEBUG
+    )
+
+
+def get_db_command_batch(db_queue):
+    # Returns (data_list, shutdown). Blocks for the first message, then waits
+    # at most DB_BATCH_WAIT_TIME for the batch to fill.
+    data = db_queue.get()
+    if data is consts.PROCESS_SHUTDOWN_SENTINEL:
+        return list(), True
+
+    data_list = [data]
+    deadline = time.monotonic() + consts.DB_BATCH_WAIT_TIME
+    while len(data_list) < consts.DB_BATCH_SIZE:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            data = db_queue.get(timeout=timeout)
+        except queue.Empty:
+            break
+
+        if data is consts.PROCESS_SHUTDOWN_SENTINEL:
+            return data_list, True
+        data_list.append(data)
 
-        except queue.Empty as e:
-            pass
+    return data_list, False
+
+
+def db_process_func(opt, db_queue, log_queue):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    db = utils.get_db(opt)
+
+    shutdown = False
+    while not shutdown:
+        data_list, shutdown = get_db_command_batch(db_queue)
+        if data_list:
+            db_batch_operation(db, data_list, log_queue)
 
     utils.close_db(db)
 
@@ -148,6 +241,7 @@ def change_working_status(db_queue, fix_id, working_status):
     data = {
         "id": fix_id,
         "working_status": working_status.value,
+        "lease_expires_at": None,
         "updated_at": datetime.now(),
     }
 
@@ -155,6 +249,42 @@ def change_working_status(db_queue, fix_id, working_status):
                    "update", args=[data, ["id"]])
 
 
+# Checkpoints. The lease is kept, the item is still being worked on.
+def change_working_status_to_collaborated(db_queue, fix_id, collaboration_id):
+    data = {
+        "id": fix_id,
+        "working_status": consts.WorkingStatus.COLLABORATED.value,
+        "collaboration_id": collaboration_id,
+        "updated_at": datetime.now(),
+    }
+    put_db_command(db_queue, consts.FIX_LIST_TABLENAME,
+                   "update", args=[data, ["id"]])
+
+
+def change_working_status_to_copied(
+        db_queue, fix_id, copy_folder_id, copy_folder_name, copy_file_id):
+    data = {
+        "id": fix_id,
+        "working_status": consts.WorkingStatus.COPIED.value,
+        "copy_folder_id": copy_folder_id,
+        "copy_folder_name": copy_folder_name,
+        "copy_file_id": copy_file_id,
+        "updated_at": datetime.now(),
+    }
+    put_db_command(db_queue, consts.FIX_LIST_TABLENAME,
+                   "update", args=[data, ["id"]])
+
+
+def get_resume_step(fix_data):
+    # The copy file ID survives a failed remove_collaboration, the
+    # COLLABORATED status does not survive a failed copy.
+    if fix_data.get("copy_file_id"):
+        return "remove_collaboration"
+    if fix_data.get("working_status") == consts.WorkingStatus.COLLABORATED.value:
+        return "copy"
+    return "collaborate"
+
+
 def change_working_status_to_complete(
         db_queue, fix_id, copy_folder_id, copy_folder_name, copy_file_id):
     data = {
@@ -163,426 +293,1034 @@ def change_working_status_to_complete(
         "copy_folder_id": copy_folder_id,
         "copy_folder_name": copy_folder_name,
         "copy_file_id": copy_file_id,
+        "lease_expires_at": None,
+        # Off the retry index, like a row that gave up.
+        "next_attempt_at": None,
         "updated_at": datetime.now(),
     }
+    data.update({f"{s}_attempt_count": None for s in STEP_FAILURE_STATUS})
     put_db_command(db_queue, consts.FIX_LIST_TABLENAME,
                    "update", args=[data, ["id"]])
 
 
-def create_root_directory_cache(
-        process_num, log_queue, root_folder, directory_cache):
-    put_log(
-        log_queue, f"[Process-{process_num}] build directory cache", logging.INFO)
-    for folder in root_folder.get_items():
-        directory_cache[folder.name] = {
-            "folder_id": folder.id, "child_folders": dict()}
-    put_log(
-        log_queue, f"[Process-{process_num}] build directory cache complete.", logging.INFO)
+# A row is claimable when nobody holds a live lease on it and it has not
+# already been finished (status written, lease released) in this run.
+def get_claimable_condition(table, run_id, now):
+    return and_(
+        table.c.working_status != consts.WorkingStatus.COMPLETE.value,
+        or_(table.c.lease_expires_at.is_(None),
+            table.c.lease_expires_at < now),
+        or_(table.c.lease_run_id.is_(None),
+            table.c.lease_run_id != run_id,
+            table.c.lease_expires_at.is_not(None)),
+        or_(table.c.next_attempt_at.is_(None),
+            table.c.next_attempt_at <= now),
+    )
+
+
+def select_claimable_restored_file_id_list(db, table, claimable, limit, claim_cursor):
+    # Due retries first, then fresh rows in id order from the cursor. Each
+    # claim reads one bounded chunk, never the whole table.
+    row_list = list(db.executable.execute(
+        select(table.c.restored_file_id).where(
+            claimable, table.c.next_attempt_at.is_not(None)
+        ).order_by(table.c.next_attempt_at).limit(limit)))
+    if row_list:
+        return list(dict.fromkeys(row.restored_file_id for row in row_list))
+
+    def _select_fresh(after_id):
+        return list(db.executable.execute(
+            select(table.c.id, table.c.restored_file_id).where(
+                claimable, table.c.id > after_id
+            ).order_by(table.c.id).limit(limit)))
+
+    row_list = _select_fresh(claim_cursor["after_id"])
+    if not row_list and claim_cursor["after_id"]:
+        # Wrap around. Leases that expired behind the cursor are claimable.
+        row_list = _select_fresh(0)
+    claim_cursor["after_id"] = row_list[-1].id if row_list else 0
+    return list(dict.fromkeys(row.restored_file_id for row in row_list))
+
+
+# Rows are claimed per restored file, limit bounds the number of rows read
+# to pick the restored files.
+def claim_fix_data_list(db, run_id, limit, claim_cursor=None):
+    table = db[consts.FIX_LIST_TABLENAME].table
+    claim_cursor = claim_cursor or {"after_id": 0}
+
+    while True:
+        now = datetime.now()
+        lease_owner = uuid.uuid4().hex
+        claimable = get_claimable_condition(table, run_id, now)
+        restored_file_id_list = select_claimable_restored_file_id_list(
+            db, table, claimable, limit, claim_cursor)
+        if not restored_file_id_list:
+            return list()
+
+        with db:
+            db.executable.execute(
+                table.update().where(
+                    claimable, table.c.restored_file_id.in_(restored_file_id_list)
+                ).values(
+                    lease_owner=lease_owner,
+                    lease_run_id=run_id,
+                    lease_expires_at=now +
+                    relativedelta(seconds=consts.FIX_LEASE_SEC),
+                ))
+
+        fix_data_list = [FixItem(*row) for row in db.executable.execute(
+            select(*FixItem.get_columns(table)).where(
+                table.c.restored_file_id.in_(restored_file_id_list),
+                table.c.lease_owner == lease_owner,
+            ).order_by(table.c.id))]
+        # Empty when another process claimed the same chunk first.
+        if fix_data_list:
+            return fix_data_list
+
+
+def release_fix_data_list(db, fix_id_list):
+    if not fix_id_list:
+        return
+
+    table = db[consts.FIX_LIST_TABLENAME].table
+    with db:
+        db.executable.execute(
+            table.update().where(table.c.id.in_(fix_id_list)).values(
+                lease_owner=None,
+                lease_run_id=None,
+                lease_expires_at=None,
+            ))
+
+
+def group_fix_data_list(fix_data_list):
+    fix_data_groups = dict()
+    for fix_data in fix_data_list:
+        key = (fix_data["restored_file_id"], fix_data["user_id"])
+        fix_data_groups.setdefault(key, list()).append(fix_data)
+    return list(fix_data_groups.values())
+
+
+def get_next_fix_data_list(db, run_id, fix_data_list_buffer, claim_size,
+                           claim_cursor=None):
+    if not fix_data_list_buffer:
+        fix_data_list_buffer.extend(group_fix_data_list(
+            claim_fix_data_list(db, run_id, claim_size, claim_cursor)))
+
+    if not fix_data_list_buffer:
+        return None
+    return fix_data_list_buffer.popleft()
+
+
+def release_fix_data_list_buffer(db, fix_data_list_buffer):
+    release_fix_data_list(db, [fix_data["id"]
+                               for fix_data_list in fix_data_list_buffer
+                               for fix_data in fix_data_list])
+
+
+def pop_retry_wait_time(retry_schedule):
+    next_attempt_at = heapq.heappop(retry_schedule)
+    return max(0, (next_attempt_at - datetime.now()).total_seconds())
+
+
+def build_root_folder_index(log_queue, db, root_folder):
+    put_log(log_queue, "build folder index", logging.INFO)
+    folder_index.put_folder_id_list(db, [
+        (root_folder.object_id, folder.name, "", folder.id)
+        for folder in utils.get_folder_items(root_folder)
+        if folder.type == "folder"
+    ])
+    put_log(log_queue, "build folder index complete.", logging.INFO)
+
+
+def get_folder_lock(folder_locks, *key):
+    # crc32 rather than hash(), which is salted per process.
+    return folder_locks[zlib.crc32("/".join(key).encode()) % len(folder_locks)]
+
+
+def create_subfolder_or_get_existing(client, parent_folder, name):
+    try:
+        return parent_folder.create_subfolder(name)
+    except BoxAPIException as e:
+        if e.status != 409:
+            raise e
+
+        # Someone else created it first. Box reports the existing folder.
+        return utils.get_conflict(client, e)
+
+
+def forget_owner_folder(db_queue, root_folder_id, fix_data):
+    # The folder index outlives the run, but a folder may have been deleted
+    # or moved in Box since. The next attempt resolves both folders again.
+    for owner_login in ("", fix_data["login"]):
+        folder_index.evict_folder_id(
+            root_folder_id, fix_data["uploader_email"], owner_login)
+        put_db_command(db_queue, consts.FOLDER_INDEX_TABLENAME, "delete", kwargs={
+            "root_folder_id": str(root_folder_id),
+            "uploader_email": fix_data["uploader_email"],
+            "owner_login": owner_login,
+        })
 
 
 def get_or_create_upload_user_folder(
-        process_num, log_queue, client, upload_user_email, root_folder, directory_cache):
-    target_user_cache = directory_cache.get(upload_user_email, dict())
-    upload_user_folder = None
+        process_num, log_queue, client, db, folder_locks, upload_user_email, root_folder):
+    if folder_id := folder_index.get_folder_id(
+            db, root_folder.object_id, upload_user_email):
+        return client.folder(folder_id)
+
+    # Single flight: workers asking for the same folder wait here and then
+    # find it in the index. Other folders use other stripes.
+    with get_folder_lock(folder_locks, root_folder.object_id, upload_user_email):
+        if folder_id := folder_index.get_folder_id(
+                db, root_folder.object_id, upload_user_email):
+            return client.folder(folder_id)
 
-    if folder_id := target_user_cache.get("folder_id", None):
-        upload_user_folder = client.folder(folder_id)
-    else:
-        for folder in root_folder.get_folders(
-                fields=["id", "name", "type"]).get_items():
-            if folder.type == "folder" and folder.name == upload_user_email:
-                upload_user_folder = folder
-                directory_cache[upload_user_email] = {
-                    "folder_id": folder.id, "child_folders": dict()}
-                break
-
-    if not upload_user_folder:
         put_log(
             log_queue, f"[Process-{process_num}] upload_user_folder '{upload_user_email}' not found in root folder. Creating...", logging.DEBUG)
         try:
-            upload_user_folder = root_folder.create_subfolder(
-                upload_user_email)
-            directory_cache[upload_user_email] = {
-                "folder_id": folder.id,
-                "child_folders": dict(),
-            }
-
+            upload_user_folder = create_subfolder_or_get_existing(
+                client, root_folder, upload_user_email)
         except Exception as e:
             put_log(
                 log_queue, f"[Process-{process_num}] Can't create '{upload_user_email}' upload_user_folder in root folder!: {e}", logging.ERROR)
             raise e
 
+        folder_index.put_folder_id(
+            db, root_folder.object_id, upload_user_email, "", upload_user_folder.object_id)
+
     return upload_user_folder
 
 
 def get_or_create_owner_folder_in_upload_user_folder(
-        process_num, log_queue, client, upload_user_folder, upload_user_email, folder_owner_email, directory_cache):
-    target_user_cache = directory_cache.get(upload_user_email, dict())
-    owner_folder_in_upload_user_folder = None
+        process_num, log_queue, client, db, folder_locks, root_folder, upload_user_folder, upload_user_email, folder_owner_email):
+    if folder_id := folder_index.get_folder_id(
+            db, root_folder.object_id, upload_user_email, folder_owner_email):
+        return client.folder(folder_id)
+
+    with get_folder_lock(folder_locks, root_folder.object_id, upload_user_email, folder_owner_email):
+        if folder_id := folder_index.get_folder_id(
+                db, root_folder.object_id, upload_user_email, folder_owner_email):
+            return client.folder(folder_id)
+
+        # Index every child found, so that one listing serves the other owners.
+        folder_index.put_folder_id_list(db, [
+            (root_folder.object_id, upload_user_email, folder.name, folder.id)
+            for folder in utils.get_folder_items(upload_user_folder)
+            if folder.type == "folder"
+        ])
+        if folder_id := folder_index.get_folder_id(
+                db, root_folder.object_id, upload_user_email, folder_owner_email):
+            return client.folder(folder_id)
 
-    if folder_id := target_user_cache.get(
-            "child_folders", {}).get(folder_owner_email):
-        owner_folder_in_upload_user_folder = client.folder(folder_id)
-    else:
-        for folder in upload_user_folder.get_items(
-                fields=["id", "name", "type"]):
-            if folder.type == "folder" and folder.name == folder_owner_email:
-                owner_folder_in_upload_user_folder = folder
-                directory_cache[upload_user_email]["child_folders"][folder_owner_email] = folder.id
-
-    if not owner_folder_in_upload_user_folder:
         put_log(
             log_queue, f"[Process-{process_num}] {upload_user_email}'s owner_folder_in_upload_user_folder ({folder_owner_email}) not found. creating...", logging.INFO)
         try:
-            owner_folder_in_upload_user_folder = upload_user_folder.create_subfolder(
-                folder_owner_email)
-            directory_cache[upload_user_email][folder_owner_email] = owner_folder_in_upload_user_folder.id
-
+            owner_folder_in_upload_user_folder = create_subfolder_or_get_existing(
+                client, upload_user_folder, folder_owner_email)
         except Exception as e:
             raise Exception(
                 f"[Process-{process_num}] Can't create '{folder_owner_email}' owner_folder_in_upload_user_folder!: {e}")
 
+        folder_index.put_folder_id(
+            db, root_folder.object_id, upload_user_email, folder_owner_email, owner_folder_in_upload_user_folder.object_id)
+
     return owner_folder_in_upload_user_folder
 
 
+def resolve_owner_folder(process_num, opt, log_queue, client, db, fix_data,
+                         folder_locks):
+    # get upload_user folder & owner folder in upload_user folder
+    root_folder = client.folder(opt["<BOX-FOLDER-ID>"])
+    upload_user_email = fix_data["uploader_email"]
+    folder_owner_email = fix_data["login"]
+
+    upload_user_folder = get_or_create_upload_user_folder(
+        process_num, log_queue, client, db, folder_locks, upload_user_email, root_folder)
+
+    if upload_user_folder:
+        put_log(
+            log_queue, f"[Process-{process_num}]👍 upload_user_folder '{upload_user_email}' found. folder ID: {upload_user_folder.object_id}", logging.DEBUG)
+    else:
+        raise Exception(
+            f"[Process-{process_num}]💀 Can't get or create upload_user_folder '{upload_user_email}'")
+
+    owner_folder_in_upload_user_folder = get_or_create_owner_folder_in_upload_user_folder(
+        process_num, log_queue, client, db, folder_locks, root_folder, upload_user_folder, upload_user_email, folder_owner_email)
+
+    if owner_folder_in_upload_user_folder:
+        put_log(
+            log_queue, f"[Process-{process_num}]👍 owner_folder_in_upload_user_folder {folder_owner_email} found in {upload_user_email}. Folder ID: {owner_folder_in_upload_user_folder.object_id}", logging.DEBUG)
+    else:
+        raise Exception(
+            f"[Process-{process_num}]💀 Can't get or create owner_folder_in_upload_user_folder {folder_owner_email} in {upload_user_email}")
+
+    return owner_folder_in_upload_user_folder
+
+
+def add_appuser_collaboration(
+        service_client, folder_owner_id, app_user_id, restored_file_id):
+    managed_user = utils.get_user(service_client, folder_owner_id)
+    app_user = utils.get_user(service_client, app_user_id)
+    target_file = service_client.as_user(managed_user).file(restored_file_id)
+    try:
+        collaboration = target_file.collaborate(
+            app_user, CollaborationRole.EDITOR,
+            fields=consts.BOX_FIELDS["collaborate"])
+    except BoxAPIException as e:
+        if e.code != "user_already_collaborator":
+            raise e
+        return None
+
+    return collaboration.object_id
+
+
+def copy_restored_file(client, restored_file_id,
+                       owner_folder_in_upload_user_folder):
+    try:
+        # copy from appuser_client
+        return client.file(restored_file_id).copy(
+            parent_folder=owner_folder_in_upload_user_folder)
+    except BoxAPIException as e:
+        if e.status != 409:
+            raise e
+        return utils.get_conflict(client, e)
+
+
+def remove_appuser_collaborations(
+        service_client, folder_owner_id, restored_file_id, collaboration_id,
+        appuesr_id_list):
+    owner_client = service_client.as_user(
+        utils.get_user(service_client, folder_owner_id))
+    if collaboration_id:
+        try:
+            owner_client.collaboration(collaboration_id).delete()
+            return
+        except BoxAPIException as e:
+            if e.status != 404:
+                raise e
+
+    # The collaboration is not known (or is stale), so look for it.
+    appuesr_id_list = [str(appuesr_id) for appuesr_id in appuesr_id_list]
+    for c in utils.get_collaborations(owner_client.file(restored_file_id)):
+        if c.response_object["accessible_by"]["id"] in appuesr_id_list:
+            c.delete()
+
+
+STEP_FAILURE_STATUS = {
+    "collaborate": consts.WorkingStatus.CAN_NOT_ADD_COLLABORATION,
+    "copy": consts.WorkingStatus.CAN_NOT_COPY,
+    "remove_collaboration": consts.WorkingStatus.CAN_NOT_REMOVE_COLLABORATION,
+}
+
+
+def attempt_operation(func, *args):
+    try:
+        return True, func(*args)
+    except Exception as e:
+        return False, e
+
+
+def get_retry_delay(attempt_count, e):
+    delay = min(consts.FIX_PROCESS_MAX_WAIT_TIME,
+                consts.FIX_PROCESS_WAIT_FOR_COLLABORATE_TIME * 2 ** (attempt_count - 1))
+    # Jitter keeps rows that failed together from coming back together.
+    return max(1, rate_limiter.get_retry_after(
+        e, random.uniform(delay / 2, delay)))
+
+
+def fail_step(process_num, db_queue, log_queue, fix_data, step, description, e,
+              retry_schedule, owner_folder_in_upload_user_folder=None,
+              reset_collaboration=False):
+    attempt_count_column = f"{step}_attempt_count"
+    attempt_count = (fix_data.get(attempt_count_column) or 0) + 1
+    data = {
+        "id": fix_data["id"],
+        "lease_expires_at": None,
+        "updated_at": datetime.now(),
+    }
+    if reset_collaboration:
+        data.update({
+            "working_status": consts.WorkingStatus.BEFORE_PROCESS.value,
+            "collaboration_id": None,
+        })
+
+    if attempt_count < consts.FIX_PROCESS_RETRY_COUNT:
+        # Hand the row back to the queue instead of sleeping on it.
+        next_attempt_at = datetime.now() + timedelta(
+            seconds=get_retry_delay(attempt_count, e))
+        data.update({
+            attempt_count_column: attempt_count,
+            "next_attempt_at": next_attempt_at,
+            "lease_owner": None,
+            "lease_run_id": None,
+        })
+        put_db_command(db_queue, consts.FIX_LIST_TABLENAME,
+                       "update", args=[data, ["id"]])
+        heapq.heappush(retry_schedule, next_attempt_at)
+        put_log(
+            log_queue,
+            f"[Process-{process_num}]⚠️ Can't {description}. Retry({attempt_count}) at {next_attempt_at:%H:%M:%S}! Error: {e}",
+            logging.WARNING
+        )
+        return
+
+    # Gave up. A later run starts again with a fresh budget.
+    data.update({f"{s}_attempt_count": None for s in STEP_FAILURE_STATUS})
+    data.update({
+        "working_status": STEP_FAILURE_STATUS[step].value,
+        "next_attempt_at": None,
+    })
+    put_db_command(db_queue, consts.FIX_LIST_TABLENAME,
+                   "update", args=[data, ["id"]])
+    put_log(
+        log_queue, f"[Process-{process_num}]⚠️ Can't {description}. Error: {e}", logging.WARNING)
+    put_step_result_log(process_num, log_queue, fix_data, step,
+                        False, owner_folder_in_upload_user_folder)
+
+
+def put_step_result_log(process_num, log_queue, fix_data, step, success_flg,
+                        owner_folder_in_upload_user_folder=None):
+    file_name = fix_data["file_name"]
+    restored_file_id = fix_data["restored_file_id"]
+
+    if step == "collaborate":
+        if success_flg:
+            put_log(
+                log_queue, f"[Process-{process_num}]👍 Create appuser collaborator to {file_name}({restored_file_id})", logging.DEBUG)
+        else:
+            put_log(
+                log_queue, f"[Process-{process_num}]💀 Can't create appuser collaboration. Gave up this work", logging.CRITICAL)
+
+    elif step == "copy":
+        if success_flg:
+            put_log(
+                log_queue, f"[Process-{process_num}]👍 Copy to {file_name}({restored_file_id}) to owner_folder_in_upload_user_folder({owner_folder_in_upload_user_folder.object_id}).", logging.DEBUG)
+        else:
+            put_log(
+                log_queue, f"[Process-{process_num}]💀 Can't copy to {file_name}({restored_file_id}) to owner_folder_in_upload_user_folder({owner_folder_in_upload_user_folder.object_id}). Gave up this work.", logging.CRITICAL)
+
+    elif step == "remove_collaboration":
+        if success_flg:
+            put_log(
+                log_queue, f"[Process-{process_num}]👍 Remove collaboration from {file_name}({restored_file_id}.", logging.DEBUG)
+        else:
+            put_log(
+                log_queue, f"[Process-{process_num}]💀 Can't remove collaboration from {file_name}({restored_file_id}. Gave up this work", logging.WARNING)
+
+
+def put_complete_log(process_num, log_queue, fix_data):
+    put_log(
+        log_queue,
+        f"[Process-{process_num}]🎉 File copy and remove collaboratoin complete!! {fix_data['file_name']}({fix_data['restored_file_id']} copy to {fix_data['uploader_email']}'s {fix_data['login']} folder!)",
+        logging.INFO,
+    )
+
+
+def put_user_cache_stats_log(process_num, log_queue):
+    put_log(
+        log_queue,
+        f"[Process-{process_num}] Box user GET calls saved: {utils.user_cache_stats['saved_calls']}",
+        logging.INFO,
+    )
+
+
+def put_copy_first_stats_log(process_num, log_queue):
+    attempts = copy_first_stats["hits"] + copy_first_stats["misses"]
+    if not attempts:
+        return
+    put_log(
+        log_queue,
+        f"[Process-{process_num}] Copy-first hit rate: {copy_first_stats['hits']}/{attempts} ({copy_first_stats['hits'] / attempts:.1%})",
+        logging.INFO,
+    )
+
+
+def create_fix_group(fix_data_list, app_user_id, client):
+    return {
+        "items": [{
+            "fix_data": fix_data,
+            "resume_step": get_resume_step(fix_data),
+            "owner_folder_in_upload_user_folder": None,
+            "copy_file_id": fix_data.get("copy_file_id"),
+            "failure": None,
+        } for fix_data in fix_data_list],
+        "app_user_id": app_user_id,
+        "client": client,
+        "collaboration_id": next((fix_data["collaboration_id"] for fix_data in fix_data_list
+                                  if fix_data.get("collaboration_id")), None),
+        "collaboration_removed": False,
+        "collaboration_skipped": False,
+        "root_folder_id": None,
+    }
+
+
+def resolve_fix_group(process_num, opt, log_queue, db, folder_locks, fix_group):
+    fix_group["root_folder_id"] = opt["<BOX-FOLDER-ID>"]
+    for item in list(fix_group["items"]):
+        fix_data = item["fix_data"]
+        try:
+            item["owner_folder_in_upload_user_folder"] = resolve_owner_folder(
+                process_num, opt, log_queue, fix_group["client"], db, fix_data, folder_locks)
+        except Exception as e:
+            # The row keeps its lease and comes back when the lease expires.
+            put_log(log_queue, str(e), logging.ERROR)
+            fix_group["items"].remove(item)
+            continue
+
+        if item["resume_step"] != "collaborate":
+            put_log(
+                log_queue, f"[Process-{process_num}] Resume {fix_data['file_name']}({fix_data['restored_file_id']}) from {item['resume_step']}.", logging.DEBUG)
+
+
+def get_fix_group_items(fix_group, step):
+    return [item for item in fix_group["items"]
+            if item["resume_step"] == step and not item["failure"]]
+
+
+# Hits and misses of the --copy-first probe in this process.
+copy_first_stats = Counter()
+
+
+def copy_first_fix_group(process_num, db_queue, log_queue, fix_group):
+    # The appuser may already read the restored file, e.g. through a
+    # collaboration on a parent folder. Then one copy proves it, and the
+    # group skips the collaboration.
+    item_list = get_fix_group_items(fix_group, "collaborate")
+    item = item_list[0]
+    fix_data = item["fix_data"]
+    try:
+        result = copy_restored_file(
+            fix_group["client"], fix_data["restored_file_id"],
+            item["owner_folder_in_upload_user_folder"])
+    except BoxAPIException as e:
+        if e.status not in (403, 404):
+            raise e
+        copy_first_stats["misses"] += 1
+        return
+    copy_first_stats["hits"] += 1
+
+    # A collaboration left behind by an earlier attempt is still removed.
+    fix_group["collaboration_skipped"] = not fix_group["collaboration_id"] and \
+        len(item_list) == len(fix_group["items"])
+    for other_item in item_list[1:]:
+        other_item["resume_step"] = "copy"
+    record_copied_item(process_num, db_queue, log_queue,
+                       fix_group, item, result)
+
+
+def collaborate_fix_group(process_num, opt, db_queue, log_queue, fix_group):
+    item_list = get_fix_group_items(fix_group, "collaborate")
+    if not item_list:
+        return
+
+    if opt.get("--copy-first"):
+        item = item_list[0]
+        success_flg, result = attempt_operation(
+            copy_first_fix_group, process_num, db_queue, log_queue, fix_group)
+        if not success_flg:
+            fix_data = item["fix_data"]
+            item["failure"] = (
+                "copy",
+                f"copy to {fix_data['file_name']}({fix_data['restored_file_id']}) to owner_folder_in_upload_user_folder({item['owner_folder_in_upload_user_folder'].object_id})",
+                result)
+        item_list = get_fix_group_items(fix_group, "collaborate")
+        if not item_list:
+            return
+
+    fix_data = item_list[0]["fix_data"]
+    service_client = utils.get_service_client(opt)
+    success_flg, result = attempt_operation(
+        add_appuser_collaboration,
+        service_client, fix_data["user_id"], fix_group["app_user_id"], fix_data["restored_file_id"])
+    if not success_flg:
+        for item in item_list:
+            fix_data = item["fix_data"]
+            item["failure"] = (
+                "collaborate",
+                f"create appuser collaborator to {fix_data['file_name']}({fix_data['restored_file_id']})",
+                result)
+        return
+
+    # Keep it, so that a retry or a later run can still delete it by ID.
+    fix_group["collaboration_id"] = result or fix_group["collaboration_id"]
+    for item in item_list:
+        put_step_result_log(process_num, log_queue,
+                            item["fix_data"], "collaborate", success_flg)
+        change_working_status_to_collaborated(
+            db_queue, item["fix_data"]["id"], fix_group["collaboration_id"])
+        item["resume_step"] = "copy"
+
+
+def copy_fix_item(process_num, db_queue, log_queue, fix_group, item):
+    if item["resume_step"] != "copy":
+        return
+
+    fix_data = item["fix_data"]
+    owner_folder_in_upload_user_folder = item["owner_folder_in_upload_user_folder"]
+    success_flg, result = attempt_operation(
+        copy_restored_file,
+        fix_group["client"], fix_data["restored_file_id"], owner_folder_in_upload_user_folder)
+    if not success_flg:
+        if isinstance(result, BoxAPIException) and result.status == 404:
+            forget_owner_folder(db_queue, fix_group["root_folder_id"], fix_data)
+        item["failure"] = (
+            "copy",
+            f"copy to {fix_data['file_name']}({fix_data['restored_file_id']}) to owner_folder_in_upload_user_folder({owner_folder_in_upload_user_folder.object_id})",
+            result)
+        return
+
+    record_copied_item(process_num, db_queue, log_queue,
+                       fix_group, item, result)
+
+
+def record_copied_item(process_num, db_queue, log_queue, fix_group, item, copy_file):
+    fix_data = item["fix_data"]
+    owner_folder_in_upload_user_folder = item["owner_folder_in_upload_user_folder"]
+    item["copy_file_id"] = copy_file.id
+    put_step_result_log(process_num, log_queue, fix_data, "copy",
+                        True, owner_folder_in_upload_user_folder)
+    change_working_status_to_copied(
+        db_queue, fix_data["id"], owner_folder_in_upload_user_folder.object_id,
+        fix_data["login"], item["copy_file_id"])
+    item["resume_step"] = None if fix_group["collaboration_skipped"] \
+        else "remove_collaboration"
+
+
+def remove_fix_group_collaboration(process_num, opt, log_queue, appuesr_id_list, fix_group):
+    item_list = get_fix_group_items(fix_group, "remove_collaboration")
+    if not item_list:
+        return
+
+    fix_data = item_list[0]["fix_data"]
+    service_client = utils.get_service_client(opt)
+    success_flg, result = attempt_operation(
+        remove_appuser_collaborations,
+        service_client, fix_data["user_id"], fix_data["restored_file_id"],
+        fix_group["collaboration_id"], appuesr_id_list)
+    if not success_flg:
+        for item in item_list:
+            fix_data = item["fix_data"]
+            item["failure"] = (
+                "remove_collaboration",
+                f"remove collaboration from {fix_data['file_name']}({fix_data['restored_file_id']}",
+                result)
+        return
+
+    fix_group["collaboration_removed"] = True
+    for item in item_list:
+        put_step_result_log(process_num, log_queue, item["fix_data"],
+                            "remove_collaboration", success_flg)
+        item["resume_step"] = None
+
+
+def record_fix_group(process_num, db_queue, log_queue, fix_group, retry_schedule):
+    for item in fix_group["items"]:
+        fix_data = item["fix_data"]
+        if item["failure"]:
+            step, description, e = item["failure"]
+            # A copy retry can not reuse a collaboration the rest of the
+            # group has already removed.
+            fail_step(process_num, db_queue, log_queue, fix_data, step, description,
+                      e, retry_schedule, item["owner_folder_in_upload_user_folder"],
+                      reset_collaboration=step == "copy" and fix_group["collaboration_removed"])
+            continue
+
+        change_working_status_to_complete(
+            db_queue, fix_data["id"], item["owner_folder_in_upload_user_folder"].object_id,
+            fix_data["login"], item["copy_file_id"])
+        put_complete_log(process_num, log_queue, fix_data)
+
+
+# All rows of a restored file share one collaboration: collaborate once,
+# copy to every upload user folder, remove the collaboration once.
+def fix_group_operation(process_num, opt, db_queue, log_queue, appuesr_id_list,
+                        fix_group, retry_schedule):
+    collaborate_fix_group(process_num, opt, db_queue, log_queue, fix_group)
+    for item in fix_group["items"]:
+        copy_fix_item(process_num, db_queue, log_queue, fix_group, item)
+    remove_fix_group_collaboration(
+        process_num, opt, log_queue, appuesr_id_list, fix_group)
+    record_fix_group(process_num, db_queue, log_queue,
+                     fix_group, retry_schedule)
+
+
 def fixer_process_func(original_process_num,
                        opt,
-                       system_status,
+                       shutdown_event,
                        db_queue,
                        log_queue,
-                       fix_queue,
+                       run_id,
                        appuser_list,
-                       directory_cache,
-                       directory_cache_lock,
-                       access_token_dict,
-                       access_token_dict_lock):
+                       folder_locks,
+                       token_manager):
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-    wg = true_gen(system_status)
-    while wg.__next__():
-        time.sleep(consts.PROCESS_BASIC_WAIT_TIME)
+    db = utils.get_db(opt)
+    fix_data_list_buffer = deque()
+    claim_cursor = {"after_id": 0}
+    retry_schedule = list()
+    appuesr_id_list = [appuser["box_user_id"] for appuser in appuser_list]
 
+    wg = true_gen(shutdown_event)
+    while wg.__next__():
         process_num = f"{original_process_num} UID: {uuid.uuid4().hex[0:8]}"
 
-        if system_status.value == consts.SystemStatus.PREPARE.value:
-            time.sleep(consts.PROCESS_BASIC_WAIT_TIME)
-            continue
-
-        if fix_queue.empty():
+        if shutdown_event.is_set():
             put_log(
-                log_queue, f'[Process-{process_num}] Fix queue is empty. exit...', logging.INFO)
+                log_queue, f'[Process-{process_num}] End of working!', logging.INFO)
             break
 
-        if system_status.value == consts.SystemStatus.SHUTDOWN_START.value:
+        fix_data_list = get_next_fix_data_list(
+            db, run_id, fix_data_list_buffer, consts.FIX_CLAIM_BATCH_SIZE,
+            claim_cursor)
+        if not fix_data_list and retry_schedule:
+            shutdown_event.wait(pop_retry_wait_time(retry_schedule))
+            continue
+        if not fix_data_list:
             put_log(
-                log_queue, f'[Process-{process_num}] End of working!', logging.INFO)
+                log_queue, f'[Process-{process_num}] Fix queue is empty. exit...', logging.INFO)
             break
 
-        client = None
         try:
-            access_token, app_user_id = get_appuser_access_token_operation(
-                opt, log_queue, appuser_list, access_token_dict, access_token_dict_lock)
-            client = utils.get_client_with_access_token(access_token)
-
+            access_token, app_user_id = token_manager.acquire()
         except Exception as e:
             put_log(
                 log_queue, f"[Process-{process_num}] Can't create box client!: {e}", logging.ERROR)
+            fix_data_list_buffer.appendleft(fix_data_list)
+            shutdown_event.wait(consts.ACCESS_TOKEN_RETRY_WAIT_TIME)
             continue
 
-        fix_data = None
         try:
-            fix_data = fix_queue.get_nowait()
-        except queue.Empty:
-            continue
-
-        # get upload_user folder & owner folder in upload_user folder
-        """
-        {
-            "test1@example.com": {
-                "folder_id": xxxxx,
-                "child_folders": {
-                    "owner@example.com": yyyyy
-                }
-            }
-        }
-        """
-
-        # get folders
-        root_folder = client.folder(opt["<BOX-FOLDER-ID>"])
-        upload_user_folder = None
-        owner_folder_in_upload_user_folder = None
-
-        upload_user_email = fix_data["uploader_email"]
-        folder_owner_email = fix_data["login"]
-        folder_owner_id = fix_data["user_id"]
-        restored_file_id = fix_data["restored_file_id"]
-        file_name = fix_data["file_name"]
-
-        with directory_cache_lock:
-            if len(directory_cache) == 0:
-                try:
-                    create_root_directory_cache(
-                        process_num, log_queue, root_folder, directory_cache)
-                except Exception as e:
-                    continue
+            client = utils.get_appuser_client(app_user_id, access_token)
+            fix_group = create_fix_group(fix_data_list, app_user_id, client)
+            resolve_fix_group(process_num, opt, log_queue,
+                              db, folder_locks, fix_group)
+            fix_group_operation(process_num, opt, db_queue, log_queue,
+                                appuesr_id_list, fix_group, retry_schedule)
+        except Exception as e:
+            put_log(log_queue, str(e), logging.ERROR)
+        finally:
+            token_manager.release(app_user_id)
 
-            try:
-                upload_user_folder = get_or_create_upload_user_folder(
-                    process_num, log_queue, client, upload_user_email, root_folder, directory_cache)
-
-                if upload_user_folder:
-                    put_log(
-                        log_queue, f"[Process-{process_num}]👍 upload_user_folder '{upload_user_email}' found. folder ID: {upload_user_folder.object_id}", logging.DEBUG)
-                else:
-                    raise Exception(
-                        f"[Process-{process_num}]💀 Can't get or create upload_user_folder '{upload_user_email}'")
-            except Exception as e:
-                put_log(log_queue, str(e), logging.ERROR)
-                continue
+    release_fix_data_list_buffer(db, fix_data_list_buffer)
+    utils.close_db(db)
+    put_user_cache_stats_log(original_process_num, log_queue)
+    put_copy_first_stats_log(original_process_num, log_queue)
 
-            try:
-                owner_folder_in_upload_user_folder = get_or_create_owner_folder_in_upload_user_folder(
-                    process_num, log_queue, client, upload_user_folder, upload_user_email, folder_owner_email, directory_cache)
+# -----------------------------------------------------------------------------
 
-                if owner_folder_in_upload_user_folder:
-                    put_log(
-                        log_queue, f"[Process-{process_num}]👍 owner_folder_in_upload_user_folder {folder_owner_email} found in {upload_user_email}. Folder ID: {owner_folder_in_upload_user_folder.id}", logging.DEBUG)
-                else:
-                    raise Exception(
-                        f"[Process-{process_num}]💀 Can't get or create owner_folder_in_upload_user_folder {folder_owner_email} in {upload_user_email}")
 
-            except Exception as e:
-                put_log(log_queue, str(e), logging.ERROR)
-                continue
+class FixPipeline:
+    # The async engine. Each restored file group passes through the stages in
+    # consts.FIX_PIPELINE_STAGES, connected by bounded queues. Every stage
+    # has its own pool of workers and skips the rows it has nothing to do for.
+    def __init__(self, original_process_num, opt, shutdown_event, db_queue,
+                 log_queue, run_id, appuser_list, folder_locks, token_manager):
+        self.process_num = original_process_num
+        self.opt = opt
+        self.shutdown_event = shutdown_event
+        self.db_queue = db_queue
+        self.log_queue = log_queue
+        self.run_id = run_id
+        self.appuesr_id_list = [appuser["box_user_id"]
+                                for appuser in appuser_list]
+        self.folder_locks = folder_locks
+        self.token_manager = token_manager
+
+        self.stage_concurrency = utils.get_stage_concurrency(opt)
+        self.queues = {
+            stage: asyncio.Queue(
+                concurrency * consts.FIX_PIPELINE_QUEUE_SIZE_PER_WORKER)
+            for stage, concurrency in self.stage_concurrency.items()
+        }
+        self.max_queue_depth = {stage: 0 for stage in self.queues}
+        self.stage_funcs = {
+            "resolve": self.resolve,
+            "collaborate": self.collaborate,
+            "copy": self.copy,
+            "remove_collaboration": self.remove_collaboration,
+            "record": self.record,
+        }
 
-        collaboration = None
-        target_file = None
+        self.db = None
+        self.fix_data_list_buffer = deque()
+        self.claim_cursor = {"after_id": 0}
+        self.retry_schedule = list()
+        self.in_flight = 0
+        self.item_done_event = asyncio.Event()
 
-        # File exist in the box?
-        success_flg = False
-        for i in range(1, consts.FIX_PROCESS_RETRY_COUNT + 1):
-            try:
-                service_client = utils.get_client(opt)
-                managed_user = service_client.user(folder_owner_id).get()
-                app_user = service_client.user(app_user_id).get()
-                target_file = service_client.as_user(
-                    managed_user).file(restored_file_id)
-                collaboration = target_file.collaborate(
-                    app_user, CollaborationRole.EDITOR)
-                success_flg = True
-                put_log(
-                    log_queue,
-                    f"[Process-{process_num}]👍 Create appuser collaborator to {file_name}({restored_file_id})",
-                    logging.DEBUG
-                )
+    async def put(self, stage, item):
+        await self.queues[stage].put(item)
+        self.max_queue_depth[stage] = max(
+            self.max_queue_depth[stage], self.queues[stage].qsize())
 
-                break
+    def put_queue_depth_log(self, title, queue_depth):
+        put_log(
+            self.log_queue,
+            f"[Process-{self.process_num}] {title}: " + ", ".join(
+                f"{stage}={depth}/{self.queues[stage].maxsize}"
+                for stage, depth in queue_depth.items()) + f", in flight={self.in_flight}",
+            logging.INFO,
+        )
 
-            except Exception as e:
-                if isinstance(e, BoxAPIException) and hasattr(
-                        e, "code") and e.code == "user_already_collaborator":
-                    success_flg = True
-                    break
+    async def report(self):
+        while True:
+            await asyncio.sleep(consts.FIX_PIPELINE_REPORT_INTERVAL_SEC)
+            self.put_queue_depth_log("Pipeline queue depth", {
+                stage: q.qsize() for stage, q in self.queues.items()})
+
+    async def produce(self):
+        claim_size = self.stage_concurrency["resolve"]
+        while not self.shutdown_event.is_set():
+            fix_data_list = await asyncio.to_thread(
+                get_next_fix_data_list, self.db, self.run_id,
+                self.fix_data_list_buffer, claim_size, self.claim_cursor)
+            if fix_data_list:
+                self.in_flight += 1
+                await self.put("resolve", create_fix_group(
+                    fix_data_list, None, None))
+                continue
 
+            if self.retry_schedule and self.retry_schedule[0] <= datetime.now():
+                heapq.heappop(self.retry_schedule)
+                continue
+            # Items still in the pipeline may yet schedule a retry.
+            if not self.retry_schedule and not self.in_flight:
                 put_log(
-                    log_queue,
-                    f"[Process-{process_num}]⚠️ Can't create appuser collaborator to {file_name}({restored_file_id}). Retry({i})! Error: {e}",
-                    logging.WARNING
-                )
-                time.sleep(consts.FIX_PROCESS_WAIT_FOR_COLLABORATE_TIME * i)
+                    self.log_queue, f'[Process-{self.process_num}] Fix queue is empty. exit...', logging.INFO)
+                return
+
+            wait_time = consts.FIX_PIPELINE_IDLE_WAIT_TIME
+            if self.retry_schedule:
+                wait_time = min(wait_time, max(0, (
+                    self.retry_schedule[0] - datetime.now()).total_seconds()))
+            self.item_done_event.clear()
+            try:
+                await asyncio.wait_for(self.item_done_event.wait(), wait_time)
+            except asyncio.TimeoutError:
+                pass
 
-        if not success_flg:
-            put_log(
-                log_queue,
-                f"[Process-{process_num}]💀 Can't create appuser collaboration. Gave up this work",
-                logging.CRITICAL
-            )
-            change_working_status(
-                db_queue, fix_data["id"], consts.WorkingStatus.CAN_NOT_ADD_COLLABORATION)
-            continue
+        put_log(
+            self.log_queue, f'[Process-{self.process_num}] End of working!', logging.INFO)
 
-        # Copy to owner_folder_in_puload_user_folder
-        success_flg = False
-        copied_file = None
-        for i in range(1, consts.FIX_PROCESS_RETRY_COUNT + 1):
+    async def run_stage(self, stage, worker_num):
+        process_num = f"{self.process_num}-{stage}-{worker_num}"
+        stage_queue = self.queues[stage]
+        while True:
+            item = await stage_queue.get()
             try:
-                # copy from appuser_client
-                copied_file = client.file(restored_file_id).copy(
-                    parent_folder=owner_folder_in_upload_user_folder)
-                success_flg = True
-                put_log(
-                    log_queue,
-                    f"[Process-{process_num}]👍 Copy to {file_name}({restored_file_id}) to owner_folder_in_upload_user_folder({owner_folder_in_upload_user_folder.id}).",
-                    logging.DEBUG
-                )
-                break
-
+                next_stage = await self.stage_funcs[stage](process_num, item)
             except Exception as e:
-                if isinstance(e, BoxAPIException) and hasattr(
-                        e, "status") and e.status == 409:
-                    copied_file = client.file(
-                        e.context_info["conflicts"]["id"]).get()
+                put_log(self.log_queue, str(e), logging.ERROR)
+                next_stage = None
+
+            if next_stage:
+                await self.put(next_stage, item)
+            else:
+                self.done(item)
+            stage_queue.task_done()
+
+    def done(self, fix_group):
+        if app_user_id := fix_group["app_user_id"]:
+            self.token_manager.release(app_user_id)
+        self.in_flight -= 1
+        self.item_done_event.set()
+
+    async def resolve(self, process_num, fix_group):
+        try:
+            access_token, fix_group["app_user_id"] = await asyncio.to_thread(
+                self.token_manager.acquire)
+        except Exception as e:
+            put_log(
+                self.log_queue, f"[Process-{process_num}] Can't create box client!: {e}", logging.ERROR)
+            # Put back like the process engine, its rows stay leased.
+            await asyncio.to_thread(
+                self.shutdown_event.wait, consts.ACCESS_TOKEN_RETRY_WAIT_TIME)
+            self.fix_data_list_buffer.appendleft(
+                [item["fix_data"] for item in fix_group["items"]])
+            return None
+
+        fix_group["client"] = utils.get_appuser_client(
+            fix_group["app_user_id"], access_token)
+        await asyncio.to_thread(
+            resolve_fix_group, process_num, self.opt, self.log_queue,
+            self.db, self.folder_locks, fix_group)
+        return "collaborate"
+
+    async def collaborate(self, process_num, fix_group):
+        await asyncio.to_thread(
+            collaborate_fix_group, process_num, self.opt, self.db_queue,
+            self.log_queue, fix_group)
+        return "copy"
+
+    async def copy(self, process_num, fix_group):
+        await asyncio.gather(*[
+            asyncio.to_thread(copy_fix_item, process_num, self.db_queue,
+                              self.log_queue, fix_group, item)
+            for item in fix_group["items"]])
+        return "remove_collaboration"
+
+    async def remove_collaboration(self, process_num, fix_group):
+        await asyncio.to_thread(
+            remove_fix_group_collaboration, process_num, self.opt,
+            self.log_queue, self.appuesr_id_list, fix_group)
+        return "record"
+
+    async def record(self, process_num, fix_group):
+        # On the loop thread, it pushes onto the retry schedule.
+        record_fix_group(process_num, self.db_queue, self.log_queue,
+                         fix_group, self.retry_schedule)
+        return None
+
+    async def run(self):
+        # Box calls block, each runs on one of these threads. The copy
+        # fan-out of a group queues on them too, it starts none of its own.
+        worker_num = sum(self.stage_concurrency.values())
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=worker_num))
+        utils.init_network(worker_num)
+        self.db = await asyncio.to_thread(utils.get_db, self.opt)
+
+        stage_tasks = {
+            stage: [asyncio.create_task(self.run_stage(stage, i))
+                    for i in range(1, concurrency + 1)]
+            for stage, concurrency in self.stage_concurrency.items()
+        }
+        report_task = asyncio.create_task(self.report())
 
-                    success_flg = True
-                    break
+        await self.produce()
 
-                put_log(
-                    log_queue,
-                    f"[Process-{process_num}]⚠️ Can't copy to {file_name}({restored_file_id}) to owner_folder_in_upload_user_folder({owner_folder_in_upload_user_folder.id}) Retry({i})! Error: {e}",
-                    logging.WARNING
-                )
-                time.sleep(consts.FIX_PROCESS_WAIT_FOR_COLLABORATE_TIME * i)
-                continue
+        # Drain the stages in order, so that nothing is left in flight.
+        for stage, tasks in stage_tasks.items():
+            await self.queues[stage].join()
+            for task in tasks:
+                task.cancel()
+        report_task.cancel()
+        self.put_queue_depth_log("Pipeline max queue depth", self.max_queue_depth)
 
-        if not success_flg:
-            put_log(
-                log_queue,
-                f"[Process-{process_num}]💀 Can't copy to {file_name}({restored_file_id}) to owner_folder_in_upload_user_folder({owner_folder_in_upload_user_folder.id}). Gave up this work.",
-                logging.CRITICAL
-            )
-            change_working_status(
-                db_queue, fix_data["id"], consts.WorkingStatus.CAN_NOT_COPY)
-            continue
+        await asyncio.to_thread(
+            release_fix_data_list_buffer, self.db, self.fix_data_list_buffer)
+        await asyncio.to_thread(utils.close_db, self.db)
+        put_user_cache_stats_log(self.process_num, self.log_queue)
+        put_copy_first_stats_log(self.process_num, self.log_queue)
 
-        # Remove Collaboration
-        appuesr_id_list = [appuser["box_user_id"] for appuser in appuser_list]
-        success_flg = False
 
-        for i in range(1, consts.FIX_PROCESS_RETRY_COUNT + 1):
-            try:
-                for c in service_client.as_user(managed_user).file(
-                        restored_file_id).get_collaborations():
-                    if c.response_object["accessible_by"]["id"] in appuesr_id_list:
-                        c.delete()
+def async_fixer_process_func(original_process_num, opt, shutdown_event, *args):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(FixPipeline(
+        original_process_num, opt, shutdown_event, *args).run())
 
-                success_flg = True
-                put_log(
-                    log_queue,
-                    f"[Process-{process_num}]👍 Remove collaboration from {file_name}({restored_file_id}.",
-                    logging.DEBUG
-                )
-                break
-            except Exception as e:
-                put_log(
-                    log_queue,
-                    f"[Process-{process_num}]⚠️ Can't remove collaboration from {file_name}({restored_file_id}. Retry({i})!. Error: {e}",
-                    logging.WARNING
-                )
-                time.sleep(consts.FIX_PROCESS_WAIT_FOR_COLLABORATE_TIME * i)
-                continue
 
-        if not success_flg:
-            put_log(
-                log_queue,
-                f"[Process-{process_num}]💀 Can't remove collaboration from {file_name}({restored_file_id}. Gave up this work",
-                logging.WARNING
-            )
-            change_working_status(
-                db_queue, fix_data["id"], consts.WorkingStatus.CAN_NOT_REMOVE_COLLABORATION)
-            continue
-
-        change_working_status_to_complete(
-            db_queue, fix_data["id"], owner_folder_in_upload_user_folder.id, folder_owner_email, copied_file.id)
-        put_log(
-            log_queue,
-            f"[Process-{process_num}]🎉 File copy and remove collaboratoin complete!! {file_name}({restored_file_id} copy to {upload_user_email}'s {folder_owner_email} folder!)",
-            logging.INFO,
-        )
+FIXER_PROCESS_FUNCS = {
+    "process": fixer_process_func,
+    "async": async_fixer_process_func,
+}
 
 
 def main(opt):
     def _core(manager):
         fixer_process_list = list()
-        log_queue = manager.Queue()
-        db_queue = manager.Queue()
-        fix_queue = manager.Queue()
-        directory_cache = manager.dict()
-        directory_cache_lock = manager.Lock()
-
-        system_status = manager.Value('i', consts.SystemStatus.PREPARE.value)
+        log_queue = Queue()
+        db_queue = Queue()
+        shutdown_event = Event()
+        run_id = uuid.uuid4().hex
+        folder_locks = [Lock() for _ in range(consts.FOLDER_LOCK_STRIPES)]
+        # Shared by every worker process forked below.
+        rate_limiter.init()
 
-        access_token_dict = manager.dict()
-        access_token_dict_lock = manager.Lock()
         appuser_list = manager.list()
 
         def shutdown_handler(signo, frame):
-            if system_status.value == consts.SystemStatus.WORKING.value:
-                system_status.value = consts.SystemStatus.SHUTDOWN_START.value
+            if not shutdown_event.is_set():
+                shutdown_event.set()
                 put_log(log_queue, 'Shutdown start..', logging.INFO)
 
         # Set Signal Handling
         signal.signal(signal.SIGINT, shutdown_handler)
 
-        # Get Working queue & appuser_list
+        # Get appuser_list
         db = utils.get_db(opt)
 
         for appuser in db[consts.APP_USER_TABLENAME].all():
             appuser_list.append(appuser)
+        token_manager = TokenManager(
+            opt, [appuser["box_user_id"] for appuser in appuser_list], manager.dict())
 
-        for fix_data in db[consts.FIX_LIST_TABLENAME].find(
-                working_status={"!=": consts.WorkingStatus.COMPLETE.value}):
-            fix_queue.put(fix_data)
+        # Build the shared folder index once for a new root folder.
+        try:
+            if not folder_index.has_root_folder(db, opt["<BOX-FOLDER-ID>"]):
+                build_root_folder_index(log_queue, db, utils.get_service_client(
+                    opt).folder(opt["<BOX-FOLDER-ID>"]))
+        except Exception as e:
+            put_log(log_queue, f"Can't build folder index: {e}", logging.ERROR)
 
+        # Never fork with an open SQLite connection.
         utils.close_db(db)
 
         # Prepare and start Log process & DB process
-        log_process = Process(target=log_process_func,
-                              args=(system_status, log_queue,))
+        log_process = Process(target=log_process_func, args=(log_queue,))
         db_process = Process(target=db_process_func, args=(
-            system_status, opt, db_queue, log_queue,))
+            opt, db_queue, log_queue,))
+        token_process = Process(target=token_process_func, args=(
+            token_manager, shutdown_event, log_queue,))
         log_process.start()
         db_process.start()
+        token_process.start()
+        token_manager.ready_event.wait()
 
         # Prepare and start fixer process
         fixer_process_func_args = [
             opt,
-            system_status,
+            shutdown_event,
             db_queue,
             log_queue,
-            fix_queue,
+            run_id,
             appuser_list,
-            directory_cache,
-            directory_cache_lock,
-            access_token_dict,
-            access_token_dict_lock
+            folder_locks,
+            token_manager,
         ]
+        fixer_process_target = FIXER_PROCESS_FUNCS[opt["--engine"]]
         for i in range(1, int(opt['--process']) + 1):
             fixer_process = Process(
-                target=fixer_process_func, args=(i, *fixer_process_func_args))
+                target=fixer_process_target, args=(i, *fixer_process_func_args))
             fixer_process_list.append(fixer_process)
             fixer_process.start()
 
-        time.sleep(consts.SHUTDOWN_BASIC_WAIT_TIME)
-        system_status.value = consts.SystemStatus.WORKING.value
         put_log(log_queue, "Fixer Process start.")
 
         for fixer_process in fixer_process_list:
             fixer_process.join()
 
         put_log(log_queue, 'Shutdown of the fixer process is complete.')
-        time.sleep(consts.SHUTDOWN_BASIC_WAIT_TIME)
-        system_status.value = consts.SystemStatus.AFTER_SHUTDOWN_FIXER_PROCESS.value
+        shutdown_event.set()
+        token_process.join()
 
+        db_queue.put(consts.PROCESS_SHUTDOWN_SENTINEL)
         db_process.join()
-        put_log(log_queue, 'Shutdown of the DB process is complete.')
-        time.sleep(consts.SHUTDOWN_BASIC_WAIT_TIME)
-        system_status.value = consts.SystemStatus.AFTER_SHUTDOWN_DB.value
 
+        put_log(log_queue, 'Shutdown of the DB process is complete.')
+        log_queue.put(consts.PROCESS_SHUTDOWN_SENTINEL)
         log_process.join()
-        logger.info('Shutdown of the log process is complete.')
-        time.sleep(consts.SHUTDOWN_BASIC_WAIT_TIME)
-        system_status.value = consts.SystemStatus.AFTER_SHUTDOWN_LOG.value
 
+        logger.info('Shutdown of the log process is complete.')
         logger.info('All Process Shutdown complete. Now Halting.')
-        time.sleep(consts.SHUTDOWN_BASIC_WAIT_TIME)
-        system_status.value = consts.SystemStatus.HALT.value
+
+    try:
+        db = utils.get_db(opt)
+        if not utils.check_db_table_and_column(db):
+            raise Exception()
+        utils.close_db(db)
+
+    except Exception as e:
+        print(f"Can't open or incorrect <DATABASE-FILE>. {e}", file=sys.stdout)
+        sys.exit(1)
 
     # Has service account root folder?
     warnings.simplefilter('ignore')
     servlice_client = utils.get_client(opt)
 
     try:
-        servlice_client.folder(opt["<BOX-FOLDER-ID>"]).get()
+        servlice_client.folder(opt["<BOX-FOLDER-ID>"]).get(
+            fields=consts.BOX_FIELDS["folder"])
     except Exception as e:
         print("Target Boxfolder does not exist. Exit", file=sys.stderr)
         sys.exit(1)
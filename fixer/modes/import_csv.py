@@ -1,9 +1,21 @@
+import bz2
+import contextlib
 import csv
+import gzip
+import hashlib
+import io
+import locale
+import lzma
+import os
 import sys
+import time
+from collections import deque
 from datetime import datetime
+from multiprocessing import Pool
 
 import consts
 import utils
+from sqlalchemy import select
 
 """
 file_id -> オリジナルのFile ID
@@ -13,14 +25,292 @@ restored_file_id -> 今回のコピー対象ファイル
 uploader_user_id -> SAに掘るフォルダ名
 """
 
+DECOMPRESSORS = {
+    b"\x1f\x8b": lambda fh: gzip.GzipFile(fileobj=fh),
+    b"BZh": bz2.BZ2File,
+    b"\xfd7zXZ\x00": lzma.LZMAFile,
+}
+
 
 def check_csv_data(csv_data):
-    if not utils.check_csv_headers(csv_data):
-        print(f'Incorrect <CSV-FILE>', file=sys.stdout)
-        sys.exit(1)
+    if all(csv_data.get(key) for key in consts.REQUIRED_CSV_COLUMNS):
+        return
+
+    utils.check_csv_headers(csv_data)
+    print(f'Incorrect <CSV-FILE>', file=sys.stdout)
+    sys.exit(1)
+
+
+def get_insert_data(csv_data, now):
+    insert_data = dict()
+    for key in consts.REQUIRED_CSV_COLUMNS:
+        insert_data[key] = csv_data[key]
+
+    insert_data["original_file_id"] = csv_data["file_id"]
+    insert_data["original_path_names"] = csv_data["path_names"]
+    insert_data["original_folder_name"] = csv_data["folder_name"]
+    insert_data['created_at'] = now
+    insert_data['updated_at'] = now
+    insert_data['working_status'] = consts.WorkingStatus.BEFORE_PROCESS.value
+    return insert_data
+
+
+def get_key(data):
+    return (str(data["restored_file_id"]), str(data["upload_user_id"]))
+
+
+def get_existing_key_set(db, table):
+    return {get_key(row._mapping) for row in db.executable.execute(
+        select(table.c.restored_file_id, table.c.upload_user_id))}
+
+
+def insert_chunk(db, table, insert_data_list):
+    if insert_data_list:
+        db.executable.execute(table.insert(), insert_data_list)
+    insert_data_list.clear()
+
+
+def get_decompressor(fh):
+    # Found by the magic bytes, whatever the file is named.
+    magic = fh.peek(6)
+    for magic_bytes, decompressor in DECOMPRESSORS.items():
+        if magic.startswith(magic_bytes):
+            return decompressor
+    return None
+
+
+def is_plain_csv_file(csv_file):
+    if csv_file == "-":
+        return False
+    with open(csv_file, "rb") as fh:
+        return get_decompressor(fh) is None
+
+
+@contextlib.contextmanager
+def open_csv_file(csv_file):
+    # "-" reads stdin. Compressed input is decompressed while it is read.
+    with contextlib.ExitStack() as stack:
+        if csv_file == "-":
+            fh = sys.stdin.buffer
+        else:
+            fh = stack.enter_context(open(csv_file, "rb"))
+        if decompressor := get_decompressor(fh):
+            fh = stack.enter_context(decompressor(fh))
+
+        text = io.TextIOWrapper(
+            fh, encoding=locale.getpreferredencoding(False), newline="")
+        try:
+            yield text
+        finally:
+            # Leaves stdin open.
+            text.detach()
+
+
+def read_csv_data(csv_file):
+    with open_csv_file(csv_file) as fh:
+        reader = csv.DictReader(fh)
+        if reader.fieldnames:
+            check_csv_data({name: name for name in reader.fieldnames})
+
+        for csv_data in reader:
+            check_csv_data(csv_data)
+            yield csv_data
+
+
+def count_quotes(fh, start, end):
+    quote_count = 0
+    fh.seek(start)
+    while start < end:
+        block = fh.read(min(consts.IMPORT_CSV_SCAN_BLOCK_BYTES, end - start))
+        if not block:
+            break
+        quote_count += block.count(b'"')
+        start += len(block)
+    return quote_count
+
+
+def find_record_boundaries(fh, start, end, chunk_num):
+    # A newline ends a record only outside a quoted field, that is after an
+    # even number of quotes ("" inside a field counts twice).
+    boundaries = [start]
+    pos, quote_count = start, 0
+    for i in range(1, chunk_num):
+        target = start + (end - start) * i // chunk_num
+        if target <= pos:
+            continue
+        quote_count += count_quotes(fh, pos, target)
+        pos = target
+
+        while pos < end:
+            fh.seek(pos)
+            block = fh.read(consts.IMPORT_CSV_SCAN_BLOCK_BYTES)
+            newline = block.find(b"\n")
+            if newline < 0:
+                quote_count += block.count(b'"')
+                pos += len(block)
+                continue
+            quote_count += block.count(b'"', 0, newline)
+            pos += newline + 1
+            if quote_count % 2 == 0:
+                break
+
+        if pos < end:
+            boundaries.append(pos)
+    boundaries.append(end)
+    return boundaries
+
+
+def parse_csv_chunk(csv_file, start, end, encoding, fieldnames):
+    # Returns (rows, index of the first invalid row or None). Rows after an
+    # invalid one are not returned, the import stops there.
+    with open(csv_file, "rb") as fh:
+        fh.seek(start)
+        text = fh.read(end - start).decode(encoding)
+
+    required_index_list = [fieldnames.index(key) if key in fieldnames else len(fieldnames)
+                           for key in consts.REQUIRED_CSV_COLUMNS]
+    row_list = list()
+    for values in csv.reader(io.StringIO(text, newline="")):
+        if not values:
+            continue
+        row_list.append(values)
+        if not all(i < len(values) and values[i] for i in required_index_list):
+            return row_list, len(row_list) - 1
+    return row_list, None
+
+
+def find_last_record_end(fh, start, end):
+    # The end of the last complete record before end. Only a record cut
+    # inside a quoted field, still being appended, is left for the next
+    # run; a last line without a newline is complete.
+    quote_count = count_quotes(fh, start, end)
+    if quote_count % 2 == 0:
+        return end
+    pos = end
+    while pos > start:
+        block_start = max(start, pos - consts.IMPORT_CSV_SCAN_BLOCK_BYTES)
+        fh.seek(block_start)
+        block = fh.read(pos - block_start)
+        i = len(block)
+        while (newline := block.rfind(b"\n", 0, i)) >= 0:
+            quote_count -= block.count(b'"', newline + 1, i)
+            i = newline
+            if quote_count % 2 == 0:
+                return block_start + newline + 1
+        quote_count -= block.count(b'"', 0, i)
+        pos = block_start
+    return start
+
+
+def get_csv_chunk_rows(fieldnames, row_list, invalid_index):
+    for i, values in enumerate(row_list):
+        csv_data = dict(zip(fieldnames, values))
+        if i == invalid_index:
+            check_csv_data(csv_data)
+        yield csv_data
+
+
+def read_csv_data_in_chunks(csv_file, start, end, pool=None, workers=1):
+    # Reads the records between the byte offsets start and end.
+    encoding = locale.getpreferredencoding(False)
+    with open(csv_file, "rb") as fh:
+        header = fh.readline()
+        chunk_num = max(workers, -(-(end - start) //
+                        consts.IMPORT_CSV_PARSE_CHUNK_BYTES))
+        boundaries = find_record_boundaries(fh, start, end, chunk_num)
+
+    if not header.strip():
+        return
+    fieldnames = next(csv.reader([header.decode(encoding)]))
+    check_csv_data({name: name for name in fieldnames})
+
+    chunk_iter = iter(zip(boundaries, boundaries[1:]))
+    if not pool:
+        for chunk in chunk_iter:
+            yield from get_csv_chunk_rows(fieldnames, *parse_csv_chunk(
+                csv_file, *chunk, encoding, fieldnames))
+        return
+
+    # Parsed in parallel, handed to the single writer in file order. At
+    # most two chunks per worker are parsed ahead of the writer.
+    pending = deque()
+    for chunk in chunk_iter:
+        pending.append(pool.apply_async(parse_csv_chunk, (
+            csv_file, *chunk, encoding, fieldnames)))
+        if len(pending) >= workers * 2:
+            break
+
+    while pending:
+        row_list, invalid_index = pending.popleft().get()
+        if chunk := next(chunk_iter, None):
+            pending.append(pool.apply_async(parse_csv_chunk, (
+                csv_file, *chunk, encoding, fieldnames)))
+        yield from get_csv_chunk_rows(fieldnames, row_list, invalid_index)
+
+
+def get_file_identity(fh):
+    stat = os.fstat(fh.fileno())
+    return f"{stat.st_dev}:{stat.st_ino}"
+
+
+def get_prefix_checksum(fh, end):
+    # Covers the head and the tail of the imported part, so a rewritten
+    # file is not taken for an appended one.
+    checksum = hashlib.sha256()
+    for start in sorted({0, max(0, end - consts.IMPORT_CSV_CHECKSUM_BYTES)}):
+        fh.seek(start)
+        checksum.update(
+            fh.read(min(consts.IMPORT_CSV_CHECKSUM_BYTES, end - start)))
+    return checksum.hexdigest()
+
+
+def get_import_range(db, csv_file):
+    # Returns (start, end, row_count). An earlier run of the same file,
+    # only appended to since, has imported row_count rows up to start.
+    state = db[consts.IMPORT_CSV_STATE_TABLENAME].find_one(
+        csv_path=os.path.realpath(csv_file))
+    with open(csv_file, "rb") as fh:
+        fh.readline()
+        start, row_count = fh.tell(), 0
+        size = os.fstat(fh.fileno()).st_size
+        if state:
+            if (state["file_identity"] == get_file_identity(fh)
+                    and state["byte_offset"] <= size
+                    and state["prefix_checksum"] == get_prefix_checksum(fh, state["byte_offset"])):
+                # An empty file was recorded at 0, before its header.
+                start = max(start, state["byte_offset"])
+                row_count = state["row_count"]
+            else:
+                print(
+                    "<CSV-FILE> has changed since the last import, importing it from the start.", file=sys.stderr)
+        end = find_last_record_end(fh, start, size)
+    return start, end, row_count
+
+
+def put_import_state(db, csv_file, end, row_count, now):
+    with open(csv_file, "rb") as fh:
+        db[consts.IMPORT_CSV_STATE_TABLENAME].upsert({
+            "csv_path": os.path.realpath(csv_file),
+            "file_identity": get_file_identity(fh),
+            "prefix_checksum": get_prefix_checksum(fh, end),
+            "byte_offset": end,
+            "row_count": row_count,
+            "updated_at": now,
+        }, ["csv_path"], ensure=False)
 
 
 def main(opt):
+    workers = int(opt.get("--workers") or 1)
+    if workers > 1 and not is_plain_csv_file(opt["<CSV-FILE>"]):
+        # Byte ranges can only be split in an uncompressed file.
+        print("--workers is ignored for compressed or stdin <CSV-FILE>.", file=sys.stderr)
+        workers = 1
+    # The pool forks before the database is opened.
+    with (Pool(workers) if workers > 1 else contextlib.nullcontext()) as pool:
+        _import_csv(opt, pool, workers)
+
+
+def _import_csv(opt, pool, workers):
     try:
         db = utils.get_db(opt)
         if not utils.check_db_table_and_column(db):
@@ -30,36 +320,49 @@ def main(opt):
         print(f"Can't open or incorrect <DATABASE-FILE>. {e}", file=sys.stdout)
         sys.exit(1)
 
-    csv_data_list = list()
-    with open(opt["<CSV-FILE>"]) as fh:
-        reader = csv.DictReader(fh)
-        for data in reader:
-            check_csv_data(data)
-            csv_data_list.append(data)
-
+    table = db[consts.FIX_LIST_TABLENAME].table
+    # Duplicates are looked up here instead of one query per line.
+    key_set = get_existing_key_set(db, table)
+    csv_file = opt["<CSV-FILE>"]
     now = datetime.now()
+    started = time.perf_counter()
 
     db.begin()
-    for i, csv_data in enumerate(csv_data_list):
-        table = db[consts.FIX_LIST_TABLENAME]
-
-        if table.find_one(
-                restored_file_id=csv_data["restored_file_id"], upload_user_id=csv_data["upload_user_id"]):
-            print(
-                f"Data already exists in db. Line: {i} {csv_data}", file=sys.stderr)
-            print("-" * 80, file=sys.stderr)
-
-        insert_data = dict()
-        for key in consts.REQUIRED_CSV_COLUMNS:
-            insert_data[key] = csv_data[key]
-
-        insert_data["original_file_id"] = csv_data["file_id"]
-        insert_data["original_path_names"] = csv_data["path_names"]
-        insert_data["original_folder_name"] = csv_data["folder_name"]
-        insert_data['created_at'] = now
-        insert_data['updated_at'] = now
-        insert_data['working_status'] = consts.WorkingStatus.BEFORE_PROCESS.value
-
-        table.insert(insert_data)
-    db.commit()
-    utils.close_db(db)
+    try:
+        # Only an uncompressed file can be resumed from a byte offset.
+        if incremental := is_plain_csv_file(csv_file):
+            start, end, line_offset = get_import_range(db, csv_file)
+            csv_data_iter = read_csv_data_in_chunks(
+                csv_file, start, end, pool, workers)
+        else:
+            line_offset = 0
+            csv_data_iter = read_csv_data(csv_file)
+
+        row_count = 0
+        insert_data_list = list()
+        for i, csv_data in enumerate(csv_data_iter, line_offset):
+            key = get_key(csv_data)
+            if key in key_set:
+                print(
+                    f"Data already exists in db. Line: {i} {csv_data}", file=sys.stderr)
+                print("-" * 80, file=sys.stderr)
+            key_set.add(key)
+
+            insert_data_list.append(get_insert_data(csv_data, now))
+            if len(insert_data_list) >= consts.IMPORT_CSV_CHUNK_SIZE:
+                insert_chunk(db, table, insert_data_list)
+            row_count += 1
+        insert_chunk(db, table, insert_data_list)
+        if incremental:
+            put_import_state(db, csv_file, end, line_offset + row_count, now)
+
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    finally:
+        utils.close_db(db)
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"Imported {row_count} rows in {elapsed:.1f}s ({row_count / max(elapsed, 1e-6):.0f} rows/s).", file=sys.stdout)
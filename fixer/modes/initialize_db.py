@@ -1,6 +1,7 @@
 import consts
 import utils
 import sys
+from sqlalchemy import Index, func, select, text
 
 
 def main(opt):
@@ -20,5 +21,25 @@ def _initialize_db(opt):
         for column_name, definition in schema['columns'].items():
             table.create_column(
                 column_name, definition['struct'], **definition['constraints'])
+        # Existing DB files are upgraded by running initialize-db again.
+        index_unique_dict = {index["name"]: bool(index["unique"])
+                             for index in db.inspect.get_indexes(table_name)}
+        for index_name, definition in schema.get('indexes', {}).items():
+            where = definition.get('where')
+            unique = definition.get('unique', False)
+            columns = [table.table.c[c] for c in definition['columns']]
+            index = Index(
+                index_name, *columns, unique=unique,
+                sqlite_where=text(where) if where else None,
+            )
+            if index_unique_dict.get(index_name, unique) != unique:
+                index.drop(db.executable)
+                index_unique_dict.pop(index_name)
+            if unique and index_name not in index_unique_dict:
+                # Keep the latest of the rows a non-unique index let in.
+                primary_column = table.table.c[schema['primary_id']]
+                db.executable.execute(table.table.delete().where(
+                    primary_column.notin_(select(func.max(primary_column)).group_by(*columns))))
+            index.create(db.executable, checkfirst=True)
     db.commit()
     utils.close_db(db)
@@ -16,7 +16,7 @@ def main(opt):
         sys.exit(1)
 
     service_client = utils.get_client(opt)
-    service_account = service_client.user().get()
+    service_account = utils.get_user(service_client, fetch=True)
     service_account.update_info(data={"space_amount": -1})
 
     folder_owner_list = [
@@ -39,7 +39,7 @@ def main(opt):
 
     # Add appusers
     for appuser_data in db[consts.APP_USER_TABLENAME].all():
-        appuser = service_client.user(appuser_data["box_user_id"])
+        appuser = utils.get_user(service_client, appuser_data["box_user_id"])
         root_folder.collaborate(appuser, CollaborationRole.EDITOR)
 
     print(f"Service account folder initialize complete", file=sys.stdout)
@@ -1,3 +1,4 @@
+import consts
 import utils
 import sys
 import pytest
@@ -6,7 +7,8 @@ import pytest
 def main(opt):
     try:
         service_client = utils.get_client(opt)
-        service_account = service_client.user().get()
+        service_account = service_client.user().get(
+            fields=consts.BOX_FIELDS["user"])
         print(f'ID: {service_account.id}')
         print(f'Login: {service_account.login}')
 
@@ -0,0 +1,87 @@
+import time
+import zlib
+from multiprocessing import Array
+
+import consts
+
+
+class RateLimiter:
+    # Token buckets kept in shared memory, so processes forked after the
+    # limiter is created draw from the same buckets. Keys are striped over
+    # a fixed number of buckets.
+    def __init__(self, rate, burst, stripes=1):
+        self.rate = rate
+        self.burst = burst
+        self.stripes = stripes
+        now = time.monotonic()
+        # tokens, updated_at, blocked_until per bucket
+        self._state = Array("d", [burst, now, 0.0] * stripes)
+
+    def _get_offset(self, key):
+        return zlib.crc32(str(key).encode()) % self.stripes * 3
+
+    def _take(self, offset):
+        now = time.monotonic()
+        tokens, updated_at, blocked_until = self._state[offset:offset + 3]
+        if blocked_until > now:
+            return blocked_until - now
+
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+
+        self._state[offset:offset + 2] = [tokens, now]
+        return wait
+
+    def acquire(self, key=""):
+        offset = self._get_offset(key)
+        while True:
+            with self._state.get_lock():
+                wait = self._take(offset)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def block(self, key, delay):
+        offset = self._get_offset(key)
+        with self._state.get_lock():
+            self._state[offset + 2] = max(
+                self._state[offset + 2], time.monotonic() + delay)
+
+
+_limiters = dict()
+
+
+def init():
+    _limiters["global"] = RateLimiter(
+        consts.RATE_LIMIT_PER_SEC, consts.RATE_LIMIT_BURST)
+    _limiters["user"] = RateLimiter(
+        consts.RATE_LIMIT_PER_USER_PER_SEC, consts.RATE_LIMIT_PER_USER_BURST,
+        consts.RATE_LIMIT_USER_STRIPES)
+    return _limiters
+
+
+def get_limiters():
+    if _limiters:
+        return _limiters
+    return init()
+
+
+def acquire(access_token):
+    limiters = get_limiters()
+    limiters["user"].acquire(access_token)
+    limiters["global"].acquire()
+
+
+def block(access_token, delay):
+    get_limiters()["user"].block(access_token, delay)
+
+
+def get_retry_after(e, default=None):
+    try:
+        return int(e.headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return default
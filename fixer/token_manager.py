@@ -0,0 +1,88 @@
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from multiprocessing import Array, Event
+
+import consts
+import utils
+from dateutil.relativedelta import relativedelta
+
+
+class TokenManager:
+    # Appuser access tokens are issued and refreshed by the token process
+    # only. Workers read them from the shared dict and never authenticate.
+    def __init__(self, opt, box_user_id_list, access_token_dict):
+        self.opt = opt
+        self.box_user_id_list = list(box_user_id_list)
+        self.access_token_dict = access_token_dict
+        self.in_flight = Array("i", len(self.box_user_id_list))
+        self.ready_event = Event()
+        self.failure_count = 0
+        self._cursor = itertools.count()
+
+    def issue(self, box_user_id):
+        access_token = utils.get_appuesr_token(self.opt, box_user_id)
+        self.access_token_dict[box_user_id] = {
+            "access_token": access_token,
+            "retrieve_datetime": datetime.now(),
+        }
+        return access_token
+
+    def issue_all(self, box_user_id_list):
+        with ThreadPoolExecutor(consts.ACCESS_TOKEN_ISSUE_CONCURRENCY) as executor:
+            futures = {box_user_id: executor.submit(self.issue, box_user_id)
+                       for box_user_id in box_user_id_list}
+        failures = {box_user_id: future.exception()
+                    for box_user_id, future in futures.items()}
+        self.failure_count = self.failure_count + 1 if any(
+            failures.values()) else 0
+        return failures
+
+    def get_refresh_time(self, box_user_id):
+        if not (token := self.access_token_dict.get(box_user_id)):
+            return None
+        return token["retrieve_datetime"] + \
+            relativedelta(seconds=consts.NEXT_REFRESH_ACCESS_TOKEN_SEC)
+
+    def get_refresh_list(self):
+        now = datetime.now()
+        return [box_user_id for box_user_id in self.box_user_id_list
+                if (refresh_time := self.get_refresh_time(box_user_id)) is None
+                or refresh_time < now]
+
+    def get_next_refresh_wait_time(self):
+        if not self.box_user_id_list:
+            return None
+        # A failed token stays due, so it is retried with backoff instead.
+        if self.failure_count:
+            return min(consts.ACCESS_TOKEN_RETRY_WAIT_TIME * 2 ** (self.failure_count - 1),
+                       consts.ACCESS_TOKEN_RETRY_MAX_WAIT_TIME)
+        if len(self.access_token_dict) < len(self.box_user_id_list):
+            return consts.ACCESS_TOKEN_RETRY_WAIT_TIME
+
+        next_refresh_time = min(self.get_refresh_time(box_user_id)
+                                for box_user_id in self.box_user_id_list)
+        return max(0, (next_refresh_time - datetime.now()).total_seconds())
+
+    def acquire(self):
+        # Least in-flight appuser first. Ties rotate, so that a single
+        # worker still spreads its calls over every appuser.
+        available = set(self.access_token_dict.keys())
+        index_list = [i for i, box_user_id in enumerate(self.box_user_id_list)
+                      if box_user_id in available]
+        if not index_list:
+            raise Exception("No appuser access token is available.")
+
+        start = next(self._cursor)
+        with self.in_flight.get_lock():
+            i = min(index_list, key=lambda i: (
+                self.in_flight[i], (i - start) % len(self.box_user_id_list)))
+            self.in_flight[i] += 1
+
+        box_user_id = self.box_user_id_list[i]
+        return self.access_token_dict[box_user_id]["access_token"], box_user_id
+
+    def release(self, box_user_id):
+        i = self.box_user_id_list.index(box_user_id)
+        with self.in_flight.get_lock():
+            self.in_flight[i] -= 1
@@ -1,14 +1,24 @@
+import os
 import sys
+import threading
+import time
+from collections import Counter, OrderedDict
 
 import dataset
 from boxsdk import Client, JWTAuth, OAuth2
+from boxsdk.network.default_network import DefaultNetwork
+from boxsdk.session.session import AuthorizedSession
+from requests.adapters import HTTPAdapter
 
 import consts
+import rate_limiter
 
 
 def get_db(opt):
     return dataset.connect(
         f"sqlite:///{opt['<DATABASE-FILE>']}",
+        engine_kwargs={"connect_args": {
+            "timeout": consts.DB_BUSY_TIMEOUT_SEC}},
     )
 
 
@@ -27,6 +37,18 @@ def check_db_table_and_column(db):
                 print(
                     f"Error: {table_name} table does not have '{column_name}' column.", file=sys.stderr)
 
+        index_unique_dict = {index["name"]: bool(index["unique"]) for index in db.inspect.get_indexes(
+            table_name)} if db.has_table(table_name) else dict()
+        for index_name, index_definition in definition.get('indexes', {}).items():
+            if index_name not in index_unique_dict:
+                success_flg = False
+                print(
+                    f"Error: {table_name} table does not have '{index_name}' index. Run initialize-db to add it.", file=sys.stderr)
+            elif index_unique_dict[index_name] != index_definition.get('unique', False):
+                success_flg = False
+                print(
+                    f"Error: {table_name} table's '{index_name}' index is not up to date. Run initialize-db to upgrade it.", file=sys.stderr)
+
     return success_flg
 
 
@@ -43,9 +65,122 @@ def check_csv_headers(csv_data):
     return success_flg
 
 
+class TTLCache:
+    # Bounded LRU mapping. Entries older than ttl seconds are treated as
+    # missing; ttl=None keeps them until evicted.
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+
+            value, expires_at = self._data[key]
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, (default, None))[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Clients and the HTTP connection pool live for the whole worker process.
+# They are dropped in forked children so that no socket is shared.
+_client_cache = dict()
+_network = dict()
+_user_cache = TTLCache(consts.USER_CACHE_SIZE, consts.USER_CACHE_TTL_SEC)
+user_cache_stats = Counter()
+
+
+def _clear_process_cache():
+    _client_cache.clear()
+    _network.clear()
+    _user_cache.clear()
+    user_cache_stats.clear()
+
+
+os.register_at_fork(after_in_child=_clear_process_cache)
+
+
+class PooledNetwork(DefaultNetwork):
+    def __init__(self, pool_size):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def request(self, method, url, access_token, **kwargs):
+        rate_limiter.acquire(access_token)
+        response = super().request(method, url, access_token, **kwargs)
+        if response.status_code == 429:
+            rate_limiter.block(access_token, rate_limiter.get_retry_after(
+                response, consts.FIX_PROCESS_WAIT_FOR_COLLABORATE_TIME))
+        return response
+
+
+def init_network(pool_size):
+    _network["network"] = PooledNetwork(pool_size)
+    return _network["network"]
+
+
+def get_network():
+    if network := _network.get("network"):
+        return network
+    return init_network(consts.HTTP_POOL_SIZE)
+
+
 def get_client_with_access_token(access_token):
-    return Client(OAuth2(client_id="", client_secret="",
-                  access_token=access_token))
+    oauth = OAuth2(client_id="", client_secret="", access_token=access_token)
+    return Client(oauth, session=AuthorizedSession(
+        oauth, network_layer=get_network()))
+
+
+def get_appuser_client(box_user_id, access_token):
+    # Replaced only when the access token of the appuser has been rotated.
+    cache_key = ("appuser", box_user_id)
+    cached_access_token, client = _client_cache.get(cache_key, (None, None))
+    if cached_access_token != access_token:
+        client = get_client_with_access_token(access_token)
+        _client_cache[cache_key] = (access_token, client)
+    return client
+
+
+def get_stage_concurrency(opt):
+    stage_concurrency = {
+        stage: int(opt["--concurrency"]) for stage in consts.FIX_PIPELINE_STAGES}
+    stage_concurrency["record"] = 1
+
+    for item in filter(None, (opt.get("--stage-concurrency") or "").split(",")):
+        stage, concurrency = item.split("=")
+        if stage.strip() not in stage_concurrency or \
+                not 1 <= int(concurrency) <= consts.FIX_PIPELINE_MAX_CONCURRENCY:
+            raise ValueError(item)
+        stage_concurrency[stage.strip()] = int(concurrency)
+    return stage_concurrency
 
 
 def get_auth(opt, box_user=None):
@@ -54,11 +189,64 @@ def get_auth(opt, box_user=None):
 
 
 def get_client(opt, box_user=None):
-    return Client(get_auth(opt, box_user=box_user))
+    auth = get_auth(opt, box_user=box_user)
+    return Client(auth, session=AuthorizedSession(
+        auth, network_layer=get_network()))
+
+
+def get_service_client(opt):
+    cache_key = ("service", opt["<JWT-FILE>"])
+    if not (client := _client_cache.get(cache_key)):
+        auth = get_auth(opt)
+        client = Client(auth, session=AuthorizedSession(
+            auth, network_layer=get_network()))
+        _client_cache[cache_key] = client
+    return client
+
+
+def get_user(client, user_id="me", fetch=False):
+    # Without fetch, return a lazy reference. It is enough for as_user(),
+    # collaborate() and JWTAuth, which only need the ID.
+    if not fetch:
+        return client.user(user_id)
+
+    # Shared by every client, the user is rebound to the caller's session.
+    # "me" is a different user for each client.
+    cache_key = (client, user_id) if user_id == "me" else str(user_id)
+    if (user := _user_cache.get(cache_key)) is not None:
+        user_cache_stats["saved_calls"] += 1
+        return user.clone(client.session)
+
+    user = client.user(user_id).get(fields=consts.BOX_FIELDS["user"])
+    _user_cache.set(cache_key, user)
+    return user
+
+
+def get_folder_items(folder):
+    return folder.get_items(limit=consts.BOX_LIST_LIMIT,
+                            fields=consts.BOX_FIELDS["folder_items"])
+
+
+def get_collaborations(item):
+    return item.get_collaborations(limit=consts.BOX_LIST_LIMIT,
+                                   fields=consts.BOX_FIELDS["collaborations"])
+
+
+def get_conflict(client, e, fetch=False):
+    # The existing item of a 409 is in context_info: a list for folders,
+    # a single item for files. Built from the payload, without a GET.
+    conflicts = e.context_info["conflicts"]
+    if isinstance(conflicts, list):
+        conflicts = conflicts[0]
+
+    item = client.translator.translate(client.session, conflicts)
+    if fetch:
+        return item.get()
+    return item
 
 
 def get_appuesr_token(opt, box_user_id):
-    sa_client = get_client(opt)
-    appuser = sa_client.user(box_user_id).get()
+    sa_client = get_service_client(opt)
+    appuser = get_user(sa_client, box_user_id)
     auth = get_auth(opt, box_user=appuser)
     return auth.authenticate_app_user()
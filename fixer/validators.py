@@ -2,6 +2,9 @@ import os
 import sys
 import re
 
+import consts
+import utils
+
 
 URL_REGEX = re.compile(
     r'^(?:http)s?://'  # http:// or https://
@@ -39,7 +42,8 @@ def check_db_file_can_create(opt):
 
 
 def check_csv_file_exist(opt):
-    if not os.path.isfile(opt['<CSV-FILE>']):
+    # "-" reads stdin.
+    if opt['<CSV-FILE>'] != "-" and not os.path.isfile(opt['<CSV-FILE>']):
         print('<CSV-FILE> does not exist.', file=sys.stderr)
         sys.exit(1)
 
@@ -58,6 +62,41 @@ def check_process_num(opt):
         sys.exit(1)
 
 
+def check_engine(opt):
+    if opt['--engine'] not in consts.FIX_ENGINES:
+        print(
+            f"--engine must be one of {', '.join(consts.FIX_ENGINES)}.", file=sys.stderr)
+        sys.exit(1)
+
+
+def check_concurrency(opt):
+    try:
+        if not 1 <= int(opt['--concurrency']) <= consts.FIX_PIPELINE_MAX_CONCURRENCY:
+            raise ValueError()
+    except Exception as e:
+        print(
+            f'--concurrency must be a number from 1 to {consts.FIX_PIPELINE_MAX_CONCURRENCY}.', file=sys.stderr)
+        sys.exit(1)
+
+
+def check_stage_concurrency(opt):
+    try:
+        utils.get_stage_concurrency(opt)
+    except Exception as e:
+        print(
+            f"--stage-concurrency must be like copy=20,collaborate=5, each from 1 to {consts.FIX_PIPELINE_MAX_CONCURRENCY}. Stages: {', '.join(consts.FIX_PIPELINE_STAGES)}.", file=sys.stderr)
+        sys.exit(1)
+
+
+def check_workers(opt):
+    try:
+        if int(opt['--workers']) < 1:
+            raise ValueError()
+    except Exception as e:
+        print('--workers must be a positive number.', file=sys.stderr)
+        sys.exit(1)
+
+
 def check_create_appuser_num(opt):
     try:
         int(opt['--create-appuser-num'])
@@ -114,20 +153,20 @@ def check_cert_and_private_key(opt):
 def validate_option(opt):
     check_funcs = {
         'initialize-db': [check_db_file_can_create],
-        'import-csv': [check_db_file_exist, check_csv_file_exist],
+        'import-csv': [check_db_file_exist, check_csv_file_exist, check_workers],
         'initialize-service-account-directory': [check_db_file_exist, check_jwt_file_exist, ],
         'create-appuser': [check_db_file_exist, check_jwt_file_exist, check_create_appuser_num, ],
         'delete-appuser': [check_db_file_exist, check_jwt_file_exist, check_box_user_id, ],
         'show-appuser-list': [check_db_file_exist],
         'show-service-account-info': [check_jwt_file_exist],
-        'fix': [check_db_file_exist, check_jwt_file_exist, check_box_folder_id, check_process_num, ],
+        'fix': [check_db_file_exist, check_jwt_file_exist, check_box_folder_id, check_process_num, check_engine, check_concurrency, check_stage_concurrency, ],
         'collaborate-and-put-csv': [check_db_file_exist, check_jwt_file_exist, check_box_folder_id, check_process_num, check_box_file_url],
         'start-webserver': [check_jwt_file_exist, check_cert_and_private_key, check_port_num],
         'emergency-remove-collaborations': [check_jwt_file_exist, check_box_folder_id],
     }
 
     for key in ("<DATABASE-FILE>", "<CSV-FILE>", "<JWT-FILE>", "--cert", "--private-key"):
-        if path := opt[key]:
+        if (path := opt[key]) and path != "-":
             opt[key] = convert_to_abs_path(opt[key])
 
     for key in check_funcs.keys():
@@ -2,13 +2,21 @@ import logging
 import multiprocessing
 import queue
 import sys
+import tempfile
+import threading
+import time
 import uuid
 from audioop import mul
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
 
 import freezegun
+import pytest
+from boxsdk.exception import BoxAPIException
+from boxsdk.util.translator import Translator
 from fixer import consts, utils
-from fixer.modes import fix
+from fixer.modes import fix, initialize_db
 from loguru import logger
 
 
@@ -103,28 +111,17 @@ def test_db_operation_if_error_occured(capsys, mocker):
 
 
 def test_log_process_func_if_queue_exist(capsys, mocker):
-    def true_gen_mock_for_log_process(system_status):
-        for i in range(1):
-            yield True
-
-        system_status.value = consts.SystemStatus.AFTER_SHUTDOWN_DB.value
-        while True:
-            yield True
-
     log_queue = multiprocessing.Queue()
-    system_status = multiprocessing.Value(
-        'i', consts.SystemStatus.WORKING.value)
 
     for i in range(1, 10 + 1):
         log_queue.put(
             {"msg": f"test-log-process-func {i}", "level": logging.INFO})
+    log_queue.put(consts.PROCESS_SHUTDOWN_SENTINEL)
 
     logger.remove()
     logger.add(sys.stdout, format='{level} {message}')
 
-    mocker.patch('fixer.modes.fix.true_gen',
-                 side_effect=true_gen_mock_for_log_process)
-    fix.log_process_func(system_status, log_queue)
+    fix.log_process_func(log_queue)
 
     captured = capsys.readouterr()
 
@@ -144,117 +141,869 @@ def test_log_process_func_if_queue_exist(capsys, mocker):
 
 
 def test_log_process_func_if_queue_does_not_exist(capsys, mocker):
-    def true_gen_mock_for_log_process(system_status):
-        for i in range(1):
-            yield True
-
-        system_status.value = consts.SystemStatus.AFTER_SHUTDOWN_DB.value
-        while True:
-            yield True
-
-    system_status = multiprocessing.Value(
-        'i', consts.SystemStatus.WORKING.value)
     log_queue = multiprocessing.Queue()
+    log_queue.put(consts.PROCESS_SHUTDOWN_SENTINEL)
     logger.remove()
     logger.add(sys.stdout, format='{level} {message}')
 
-    mocker.patch('fixer.modes.fix.true_gen',
-                 side_effect=true_gen_mock_for_log_process)
-    fix.log_process_func(system_status, log_queue)
+    fix.log_process_func(log_queue)
 
 
-def test_get_appuser_access_token_operation(capsys, mocker, benchmark):
+def test_db_process_func(mocker):
+    db = _create_fix_list_db(2)
+    opt = {"<DATABASE-FILE>": db.url.replace("sqlite:///", "")}
+    db_queue, log_queue = queue.Queue(), queue.Queue()
+    db[consts.FIX_LIST_TABLENAME].update({
+        "id": 2, "copy_attempt_count": 2, "next_attempt_at": datetime.now()}, ["id"])
+
+    fix.change_working_status(db_queue, 1, consts.WorkingStatus.CAN_NOT_COPY)
+    fix.change_working_status_to_complete(db_queue, 2, 10, "owner", 20)
+    db_queue.put(consts.PROCESS_SHUTDOWN_SENTINEL)
+
+    fix.db_process_func(opt, db_queue, log_queue)
+
+    db = utils.get_db(opt)
+    table = db[consts.FIX_LIST_TABLENAME]
+    assert table.find_one(id=1)["working_status"] == \
+        consts.WorkingStatus.CAN_NOT_COPY.value
+    row = table.find_one(id=2)
+    assert row["working_status"] == consts.WorkingStatus.COMPLETE.value
+    assert row["next_attempt_at"] is None
+    assert row["copy_attempt_count"] is None
+    assert db_queue.empty()
+
+
+def _create_token_manager(mocker, appuser_num):
     opt = {
         '<DATABASE-FILE>': ':memory:',
         '<JWT-FILE>': './test_assets/test-jwt-file.json'
     }
-    manager = multiprocessing.Manager()
-
-    appuser_list = manager.list()
-    for i in range(1, 100 + 1):
-        appuser_list.append({"box_user_id": i, "login": uuid.uuid4(
-        ).hex[0:8], "login": uuid.uuid4().hex[0:8]})
-
-    log_queue = manager.Queue()
-    access_token_dict_lock = manager.Lock()
-    access_token_dict = manager.dict()
+    mocker.patch("utils.get_appuesr_token",
+                 side_effect=lambda opt, box_user_id: uuid.uuid4().hex[0:8])
+    return fix.TokenManager(opt, range(1, appuser_num + 1), dict())
 
-    access_token_list = [uuid.uuid4().hex[0:8]
-                         for i in range(len(appuser_list))]
 
-    def _access_token_gen():
-        for access_token in access_token_list:
-            yield access_token
+def test_token_process_func(mocker):
+    token_manager = _create_token_manager(mocker, 100)
+    shutdown_event = multiprocessing.Event()
+    shutdown_event.set()
+    log_queue = queue.Queue()
 
-    access_token_gen = _access_token_gen()
-    mocker.patch("boxsdk.auth.jwt_auth.JWTAuth.authenticate_app_user",
-                 side_effect=access_token_gen.__next__)
-    mocker.patch("boxsdk.object.user.User.get", return_value=None)
+    fix.token_process_func(token_manager, shutdown_event, log_queue)
 
-    for i in range(len(appuser_list) - 1):
-        access_token, _ = fix.get_appuser_access_token_operation(
-            opt, log_queue, appuser_list, access_token_dict, access_token_dict_lock)
-        assert access_token in access_token_list
-
-    assert len(access_token_dict) == len(appuser_list)
+    assert token_manager.ready_event.is_set()
+    assert len(token_manager.access_token_dict) == 100
     assert log_queue.get()[
         "msg"] == "Obtain access tokens for all Appusers for initial startup."
-
     while not log_queue.empty():
         assert "access token has been obtained" in log_queue.get()["msg"]
 
 
-def test_get_appuser_access_token_operation_if_token_expired(
-        capsys, mocker, benchmark):
-    opt = {
-        '<DATABASE-FILE>': ':memory:',
-        '<JWT-FILE>': './test_assets/test-jwt-file.json'
-    }
-    manager = multiprocessing.Manager()
-
-    appuser_list = manager.list()
-    for i in range(1, 100 + 1):
-        appuser_list.append({"box_user_id": i, "login": uuid.uuid4().hex[0:8]})
+def test_token_manager_refresh(mocker):
+    token_manager = _create_token_manager(mocker, 10)
 
-    log_queue = manager.Queue()
-    access_token_dict_lock = manager.Lock()
-    access_token_dict = manager.dict()
+    with freezegun.freeze_time('2000-01-01 00:00:00'):
+        assert token_manager.get_refresh_list() == list(range(1, 10 + 1))
+        token_manager.issue_all(token_manager.get_refresh_list())
+        token_manager.access_token_dict[3]["retrieve_datetime"] = datetime(
+            1999, 12, 31, 23, 50, 0)
+        assert token_manager.get_next_refresh_wait_time() == \
+            consts.NEXT_REFRESH_ACCESS_TOKEN_SEC - 600
 
-    def gen_uuid():
-        return uuid.uuid4().hex[0:8]
+    with freezegun.freeze_time('2000-01-01 00:45:00'):
+        assert token_manager.get_refresh_list() == [3]
 
-    mocker.patch(
-        "boxsdk.auth.jwt_auth.JWTAuth.authenticate_app_user", side_effect=gen_uuid)
-    mocker.patch("boxsdk.object.user.User.get", return_value=None)
+    with freezegun.freeze_time('2000-01-01 00:45:01'):
+        assert len(token_manager.get_refresh_list()) == 10
 
-    # First take
-    with freezegun.freeze_time('2000-01-01 00:00:00'):
-        _ = fix.get_appuser_access_token_operation(
-            opt, log_queue, appuser_list, access_token_dict, access_token_dict_lock)
+    mocker.patch("utils.get_appuesr_token",
+                 side_effect=Exception("testException"))
+    failures = token_manager.issue_all([1])
+    assert str(failures[1]) == "testException"
 
-        # Second take
-        for i in range(len(appuser_list)):
-            _ = fix.get_appuser_access_token_operation(
-                opt, log_queue, appuser_list, access_token_dict, access_token_dict_lock)
 
-        assert log_queue.get()[
-            "msg"] == "Obtain access tokens for all Appusers for initial startup."
-        while not log_queue.empty():
-            assert "access token has been obtained" in log_queue.get()["msg"]
+def test_token_manager_refresh_if_failed(mocker):
+    token_manager = _create_token_manager(mocker, 2)
+    token_manager.issue_all([1, 2])
 
-    # Safe
-    with freezegun.freeze_time('2000-01-01 00:45:00'):
-        for i in range(len(appuser_list)):
-            _ = fix.get_appuser_access_token_operation(
-                opt, log_queue, appuser_list, access_token_dict, access_token_dict_lock)
-        assert log_queue.empty()
+    get_appuesr_token = mocker.patch("utils.get_appuesr_token",
+                                     side_effect=Exception("testException"))
+    with freezegun.freeze_time('2000-01-01 00:00:00'):
+        # The expired token keeps failing, it is retried with backoff.
+        for wait_time in (10, 20, 40, 80, 160, 300, 300):
+            token_manager.issue_all([1])
+            assert token_manager.get_next_refresh_wait_time() == wait_time
+
+        get_appuesr_token.side_effect = None
+        token_manager.issue_all([1])
+        assert token_manager.failure_count == 0
+        assert token_manager.get_next_refresh_wait_time() > 0
+
+
+def test_token_manager_acquire_least_loaded(mocker, benchmark):
+    token_manager = _create_token_manager(mocker, 3)
+    token_manager.issue_all([1, 2, 3])
+
+    acquired = [token_manager.acquire()[1] for _ in range(3)]
+    assert sorted(acquired) == [1, 2, 3]
+
+    token_manager.release(2)
+    access_token, box_user_id = token_manager.acquire()
+    assert box_user_id == 2
+    assert access_token == token_manager.access_token_dict[2]["access_token"]
+
+    def _acquire_and_release():
+        token_manager.release(token_manager.acquire()[1])
+    benchmark(_acquire_and_release)
+    assert list(token_manager.in_flight) == [1, 1, 1]
+
+
+def test_token_manager_acquire_if_no_token(mocker):
+    token_manager = _create_token_manager(mocker, 3)
+    with pytest.raises(Exception):
+        token_manager.acquire()
+
+
+class BoxFolder:
+    object_id = "1"
+
+
+class BoxFile:
+    id = 2
+
+
+FIX_DATA = {
+    "id": 1,
+    "restored_file_id": 10,
+    "file_name": "test_file",
+    "user_id": 100,
+    "login": "folder-owner@example.com",
+    "uploader_email": "upload@example.com",
+}
+
+
+def _fix_group_operation_args(db_queue, log_queue, fix_data_list=[FIX_DATA]):
+    opt = {'<JWT-FILE>': './test_assets/test-jwt-file.json'}
+    fix_group = fix.create_fix_group(fix_data_list, 1, None)
+    for item in fix_group["items"]:
+        item["owner_folder_in_upload_user_folder"] = BoxFolder()
+    return ["1", opt, db_queue, log_queue, [1], fix_group, list()]
+
+
+def test_fix_group_operation(mocker):
+    mocker.patch('fixer.modes.fix.add_appuser_collaboration',
+                 return_value="300")
+    mocker.patch('fixer.modes.fix.copy_restored_file',
+                 return_value=BoxFile())
+    remove_appuser_collaborations = mocker.patch(
+        'fixer.modes.fix.remove_appuser_collaborations', return_value=None)
+
+    db_queue, log_queue = queue.Queue(), queue.Queue()
+    fix.fix_group_operation(*_fix_group_operation_args(db_queue, log_queue))
+
+    collaborated_data = db_queue.get_nowait()["args"][0]
+    copied_data = db_queue.get_nowait()["args"][0]
+    data = db_queue.get_nowait()["args"][0]
+    assert collaborated_data["working_status"] == \
+        consts.WorkingStatus.COLLABORATED.value
+    assert collaborated_data["collaboration_id"] == "300"
+    assert copied_data["working_status"] == consts.WorkingStatus.COPIED.value
+    assert copied_data["copy_file_id"] == BoxFile.id
+    assert data["working_status"] == consts.WorkingStatus.COMPLETE.value
+    assert data["copy_folder_id"] == BoxFolder.object_id
+    assert data["copy_file_id"] == BoxFile.id
+    assert db_queue.empty()
+    assert remove_appuser_collaborations.call_args.args[3] == "300"
+
+
+def test_fix_group_operation_if_already_collaborator(mocker):
+    mocker.patch('fixer.modes.fix.add_appuser_collaboration',
+                 return_value=None)
+    mocker.patch('fixer.modes.fix.copy_restored_file',
+                 return_value=BoxFile())
+    remove_appuser_collaborations = mocker.patch(
+        'fixer.modes.fix.remove_appuser_collaborations', return_value=None)
+
+    db_queue, log_queue = queue.Queue(), queue.Queue()
+    args = _fix_group_operation_args(db_queue, log_queue, [
+        {**FIX_DATA, "collaboration_id": "301"}])
+    fix.fix_group_operation(*args)
+
+    # The ID saved by an earlier attempt is used.
+    assert remove_appuser_collaborations.call_args.args[3] == "301"
+    assert db_queue.get_nowait()["args"][0]["collaboration_id"] == "301"
+    data = list(db_queue.queue)[-1]["args"][0]
+    assert data["working_status"] == consts.WorkingStatus.COMPLETE.value
+
+
+def test_fix_group_operation_if_copy_failed(mocker):
+    mocker.patch('fixer.modes.fix.add_appuser_collaboration',
+                 return_value=None)
+    mocker.patch('fixer.modes.fix.copy_restored_file',
+                 side_effect=Exception('testException'))
+
+    db_queue, log_queue = queue.Queue(), queue.Queue()
+    args = _fix_group_operation_args(db_queue, log_queue)
+    start = datetime.now()
+    fix.fix_group_operation(*args)
+
+    # Retry is scheduled, not slept on.
+    assert datetime.now() - start < timedelta(seconds=1)
+    assert db_queue.get_nowait()["args"][0]["working_status"] == \
+        consts.WorkingStatus.COLLABORATED.value
+    data = db_queue.get_nowait()["args"][0]
+    assert "working_status" not in data
+    assert data["copy_attempt_count"] == 1
+    assert data["lease_run_id"] is None
+    assert args[-1] == [data["next_attempt_at"]]
+    assert data["next_attempt_at"] > start
+    assert db_queue.empty()
+
+
+def test_fix_group_operation_if_copy_retry_count_exceeded(mocker):
+    mocker.patch('fixer.modes.fix.add_appuser_collaboration',
+                 return_value=None)
+    mocker.patch('fixer.modes.fix.copy_restored_file',
+                 side_effect=Exception('testException'))
+
+    db_queue, log_queue = queue.Queue(), queue.Queue()
+    args = _fix_group_operation_args(db_queue, log_queue, [
+        {**FIX_DATA, "copy_attempt_count": consts.FIX_PROCESS_RETRY_COUNT - 1}])
+    fix.fix_group_operation(*args)
+
+    data = list(db_queue.queue)[-1]["args"][0]
+    assert data["working_status"] == consts.WorkingStatus.CAN_NOT_COPY.value
+    assert data["copy_attempt_count"] is None
+    assert args[-1] == []
+
+
+def test_copy_restored_file_if_already_copied(mocker):
+    client = utils.get_client_with_access_token("test-access-token")
+    restored_file = mocker.Mock()
+    restored_file.copy.side_effect = BoxAPIException(
+        409, code="item_name_in_use",
+        context_info={"conflicts": {"type": "file", "id": "20", "name": "test_file"}})
+    mocker.patch.object(client, "file", return_value=restored_file)
+
+    copy_file = fix.copy_restored_file(client, 10, BoxFolder())
+    assert copy_file.id == "20"
+    client.file.assert_called_once_with(10)
+
+
+def test_get_resume_step():
+    assert fix.get_resume_step(FIX_DATA) == "collaborate"
+    assert fix.get_resume_step({
+        **FIX_DATA, "working_status": consts.WorkingStatus.CAN_NOT_COPY.value}) == "collaborate"
+    assert fix.get_resume_step({
+        **FIX_DATA, "working_status": consts.WorkingStatus.COLLABORATED.value}) == "copy"
+    assert fix.get_resume_step({
+        **FIX_DATA, "working_status": consts.WorkingStatus.COPIED.value,
+        "copy_file_id": 2}) == "remove_collaboration"
+    assert fix.get_resume_step({
+        **FIX_DATA, "working_status": consts.WorkingStatus.CAN_NOT_REMOVE_COLLABORATION.value,
+        "copy_file_id": 2}) == "remove_collaboration"
+
+
+def test_fix_group_operation_if_copied(mocker):
+    add_appuser_collaboration = mocker.patch(
+        'fixer.modes.fix.add_appuser_collaboration')
+    copy_restored_file = mocker.patch('fixer.modes.fix.copy_restored_file')
+    remove_appuser_collaborations = mocker.patch(
+        'fixer.modes.fix.remove_appuser_collaborations', return_value=None)
+
+    db_queue, log_queue = queue.Queue(), queue.Queue()
+    args = _fix_group_operation_args(db_queue, log_queue, [
+        {**FIX_DATA, "working_status": consts.WorkingStatus.COPIED.value,
+         "collaboration_id": "300", "copy_file_id": 20}])
+    fix.fix_group_operation(*args)
+
+    add_appuser_collaboration.assert_not_called()
+    copy_restored_file.assert_not_called()
+    assert remove_appuser_collaborations.call_args.args[3] == "300"
+    data = db_queue.get_nowait()["args"][0]
+    assert data["working_status"] == consts.WorkingStatus.COMPLETE.value
+    assert data["copy_file_id"] == 20
+    assert db_queue.empty()
+
+
+def test_fix_group_operation_if_restored_file_is_shared(mocker):
+    add_appuser_collaboration = mocker.patch(
+        'fixer.modes.fix.add_appuser_collaboration', return_value="300")
+    copy_restored_file = mocker.patch('fixer.modes.fix.copy_restored_file',
+                                      return_value=BoxFile())
+    remove_appuser_collaborations = mocker.patch(
+        'fixer.modes.fix.remove_appuser_collaborations', return_value=None)
+
+    db_queue, log_queue = queue.Queue(), queue.Queue()
+    fix.fix_group_operation(*_fix_group_operation_args(db_queue, log_queue, [
+        FIX_DATA, {**FIX_DATA, "id": 2, "uploader_email": "upload-2@example.com"}]))
+
+    add_appuser_collaboration.assert_called_once()
+    assert copy_restored_file.call_count == 2
+    remove_appuser_collaborations.assert_called_once()
+    complete_id_list = [
+        data["args"][0]["id"] for data in db_queue.queue
+        if data["args"][0]["working_status"] == consts.WorkingStatus.COMPLETE.value]
+    assert complete_id_list == [1, 2]
+
+
+def test_fix_group_operation_if_copy_first_hit(mocker):
+    add_appuser_collaboration = mocker.patch(
+        'fixer.modes.fix.add_appuser_collaboration')
+    copy_restored_file = mocker.patch('fixer.modes.fix.copy_restored_file',
+                                      return_value=BoxFile())
+    remove_appuser_collaborations = mocker.patch(
+        'fixer.modes.fix.remove_appuser_collaborations')
+    hits = fix.copy_first_stats["hits"]
+
+    db_queue, log_queue = queue.Queue(), queue.Queue()
+    args = _fix_group_operation_args(db_queue, log_queue, [
+        FIX_DATA, {**FIX_DATA, "id": 2}])
+    args[1]["--copy-first"] = True
+    fix.fix_group_operation(*args)
+
+    add_appuser_collaboration.assert_not_called()
+    remove_appuser_collaborations.assert_not_called()
+    assert copy_restored_file.call_count == 2
+    assert fix.copy_first_stats["hits"] == hits + 1
+    status_list = [data["args"][0]["working_status"]
+                   for data in db_queue.queue]
+    assert status_list == [consts.WorkingStatus.COPIED.value] * 2 + \
+        [consts.WorkingStatus.COMPLETE.value] * 2
+
+
+def test_fix_group_operation_if_copy_first_missed(mocker):
+    add_appuser_collaboration = mocker.patch(
+        'fixer.modes.fix.add_appuser_collaboration', return_value="300")
+    copy_restored_file = mocker.patch(
+        'fixer.modes.fix.copy_restored_file',
+        side_effect=[BoxAPIException(404), BoxFile()])
+    remove_appuser_collaborations = mocker.patch(
+        'fixer.modes.fix.remove_appuser_collaborations', return_value=None)
+    misses = fix.copy_first_stats["misses"]
+
+    db_queue, log_queue = queue.Queue(), queue.Queue()
+    args = _fix_group_operation_args(db_queue, log_queue)
+    args[1]["--copy-first"] = True
+    fix.fix_group_operation(*args)
+
+    add_appuser_collaboration.assert_called_once()
+    assert copy_restored_file.call_count == 2
+    remove_appuser_collaborations.assert_called_once()
+    assert fix.copy_first_stats["misses"] == misses + 1
+    data = list(db_queue.queue)[-1]["args"][0]
+    assert data["working_status"] == consts.WorkingStatus.COMPLETE.value
+
+    fix.put_copy_first_stats_log("1", log_queue)
+    assert "Copy-first hit rate: " in list(log_queue.queue)[-1]["msg"]
+
+
+def test_fix_group_operation_if_copy_failed_in_group(mocker):
+    mocker.patch('fixer.modes.fix.add_appuser_collaboration',
+                 return_value="300")
+    mocker.patch('fixer.modes.fix.copy_restored_file',
+                 side_effect=[BoxFile(), Exception('testException')])
+    mocker.patch('fixer.modes.fix.remove_appuser_collaborations',
+                 return_value=None)
+
+    db_queue, log_queue = queue.Queue(), queue.Queue()
+    fix.fix_group_operation(*_fix_group_operation_args(db_queue, log_queue, [
+        FIX_DATA, {**FIX_DATA, "id": 2}]))
+
+    # The collaboration is gone, so the retry starts from collaborate.
+    data_list = [data["args"][0] for data in db_queue.queue]
+    retry_data = [data for data in data_list if data["id"] == 2][-1]
+    assert retry_data["copy_attempt_count"] == 1
+    assert retry_data["working_status"] == \
+        consts.WorkingStatus.BEFORE_PROCESS.value
+    assert retry_data["collaboration_id"] is None
+    assert fix.get_resume_step(retry_data) == "collaborate"
+    assert [data for data in data_list if data["id"] == 1][-1]["working_status"] == \
+        consts.WorkingStatus.COMPLETE.value
+
+
+def test_fix_pipeline_if_collaborated(mocker):
+    _mock_fix_steps(mocker)
+    add_appuser_collaboration = mocker.patch(
+        'fixer.modes.fix.add_appuser_collaboration')
+    db = _create_fix_list_db(1)
+    db[consts.FIX_LIST_TABLENAME].update(
+        {"id": 1, "working_status": consts.WorkingStatus.COLLABORATED.value,
+         "collaboration_id": "300"}, ["id"])
+
+    db_command_list, _ = _run_fix_pipeline(db, None)
+
+    add_appuser_collaboration.assert_not_called()
+    assert [data["args"][0]["working_status"] for data in db_command_list] == [
+        consts.WorkingStatus.COPIED.value, consts.WorkingStatus.COMPLETE.value]
+    assert fix.remove_appuser_collaborations.call_args.args[3] == "300"
+
+
+class BoxCollaboration:
+    def __init__(self, accessible_by_id):
+        self.response_object = {"accessible_by": {"id": accessible_by_id}}
+        self.deleted = False
+
+    def delete(self):
+        self.deleted = True
+
+
+def test_remove_appuser_collaborations(mocker):
+    service_client = mocker.MagicMock()
+    owner_client = service_client.as_user.return_value
+    collaboration_list = [BoxCollaboration("1"), BoxCollaboration("5")]
+    owner_client.file.return_value.get_collaborations.return_value = collaboration_list
+
+    fix.remove_appuser_collaborations(service_client, None, 10, "300", [1])
+    owner_client.collaboration.assert_called_once_with("300")
+    owner_client.collaboration.return_value.delete.assert_called_once()
+    owner_client.file.assert_not_called()
+
+    # Stale ID: fall back to the listing
+    owner_client.collaboration.return_value.delete.side_effect = \
+        fix.BoxAPIException(404)
+    fix.remove_appuser_collaborations(service_client, None, 10, "300", [1])
+    assert [c.deleted for c in collaboration_list] == [True, False]
+
+    collaboration_list[0].deleted = False
+    fix.remove_appuser_collaborations(service_client, None, 10, None, [1])
+    assert [c.deleted for c in collaboration_list] == [True, False]
+
+
+def test_get_retry_delay():
+    for attempt_count in range(1, consts.FIX_PROCESS_RETRY_COUNT):
+        delay = consts.FIX_PROCESS_WAIT_FOR_COLLABORATE_TIME * \
+            2 ** (attempt_count - 1)
+        delay = min(delay, consts.FIX_PROCESS_MAX_WAIT_TIME)
+        assert delay / 2 <= fix.get_retry_delay(attempt_count, None) <= delay
+
+    e = fix.BoxAPIException(429, headers={"Retry-After": "30"})
+    assert fix.get_retry_delay(1, e) == 30
+
+
+def _create_fix_list_db(row_num, restored_file_num=None):
+    db_filename = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.db')
+    opt = {"<DATABASE-FILE>": db_filename}
+    initialize_db.main(opt)
 
-    # All out!!
-    with freezegun.freeze_time('2000-01-01 00:45:01'):
-        for i in range(len(appuser_list)):
-            _ = fix.get_appuser_access_token_operation(
-                opt, log_queue, appuser_list, access_token_dict, access_token_dict_lock)
-        assert not log_queue.empty()
-        while not log_queue.empty():
-            data = log_queue.get_nowait()
-            assert "access token is about to expire. A new one will be issued." in data["msg"]
+    db = utils.get_db(opt)
+    now = datetime.now()
+    for i in range(1, row_num + 1):
+        db[consts.FIX_LIST_TABLENAME].insert({
+            "restored_file_id": (i - 1) % restored_file_num + 1 if restored_file_num else i,
+            "file_name": f"test_file_{i}",
+            "original_file_id": i,
+            "original_path_names": "/original/file/path",
+            "original_folder_name": "Original Folder Name",
+            "user_id": 1,
+            "login": "folder-owner@example.com",
+            "upload_user_id": 2,
+            "uploader_email": "upload@example.com",
+            "working_status": consts.WorkingStatus.BEFORE_PROCESS.value,
+            "created_at": now,
+            "updated_at": now,
+        })
+    return db
+
+
+def test_claim_fix_data_list():
+    db = _create_fix_list_db(5)
+    db[consts.FIX_LIST_TABLENAME].update(
+        {"id": 5, "working_status": consts.WorkingStatus.COMPLETE.value}, ["id"])
+
+    first = fix.claim_fix_data_list(db, "run-1", 3)
+    second = fix.claim_fix_data_list(db, "run-1", 3)
+    assert [d["id"] for d in first] == [1, 2, 3]
+    assert [d["id"] for d in second] == [4]
+    assert fix.claim_fix_data_list(db, "run-1", 3) == []
+
+
+def test_claim_fix_data_list_with_cursor():
+    db = _create_fix_list_db(5)
+    claim_cursor = {"after_id": 0}
+
+    id_list = [[d["id"] for d in fix.claim_fix_data_list(db, "run-1", 2, claim_cursor)]
+               for _ in range(3)]
+    assert id_list == [[1, 2], [3, 4], [5]]
+    assert claim_cursor == {"after_id": 5}
+
+    # Wraps around to the leases that expired behind the cursor.
+    with freezegun.freeze_time(datetime.now() + timedelta(seconds=consts.FIX_LEASE_SEC + 1)):
+        assert [d["id"] for d in fix.claim_fix_data_list(
+            db, "run-2", 2, claim_cursor)] == [1, 2]
+    assert claim_cursor == {"after_id": 2}
+
+
+def test_claim_fix_data_list_if_finished_in_same_run():
+    db = _create_fix_list_db(2)
+    fix.claim_fix_data_list(db, "run-1", 2)
+
+    db_queue = queue.Queue()
+    fix.change_working_status(
+        db_queue, 1, consts.WorkingStatus.CAN_NOT_COPY)
+    fix.db_operation(db, db_queue.get_nowait(), queue.Queue())
+
+    # Finished rows are not claimed again by the same run, only by the next one.
+    with freezegun.freeze_time(datetime.now() + timedelta(seconds=consts.FIX_LEASE_SEC + 1)):
+        assert [d["id"] for d in fix.claim_fix_data_list(db, "run-1", 2)] == [2]
+    assert [d["id"] for d in fix.claim_fix_data_list(db, "run-2", 2)] == [1]
+
+
+def test_claim_fix_data_list_if_lease_expired():
+    db = _create_fix_list_db(1)
+    assert len(fix.claim_fix_data_list(db, "run-1", 1)) == 1
+    assert fix.claim_fix_data_list(db, "run-2", 1) == []
+
+    with freezegun.freeze_time(datetime.now() + timedelta(seconds=consts.FIX_LEASE_SEC + 1)):
+        assert len(fix.claim_fix_data_list(db, "run-2", 1)) == 1
+
+
+def test_claim_fix_data_list_if_retry_scheduled():
+    db = _create_fix_list_db(3)
+    now = datetime.now()
+    db[consts.FIX_LIST_TABLENAME].update(
+        {"id": 1, "next_attempt_at": now + timedelta(seconds=60)}, ["id"])
+    db[consts.FIX_LIST_TABLENAME].update(
+        {"id": 3, "next_attempt_at": now - timedelta(seconds=1)}, ["id"])
+
+    assert [d["id"] for d in fix.claim_fix_data_list(db, "run-1", 1)] == [3]
+    assert [d["id"] for d in fix.claim_fix_data_list(db, "run-1", 3)] == [2]
+    with freezegun.freeze_time(now + timedelta(seconds=61)):
+        assert [d["id"] for d in fix.claim_fix_data_list(db, "run-1", 3)] == [1]
+
+
+def test_pop_retry_wait_time():
+    now = datetime.now()
+    retry_schedule = list()
+    for seconds in (30, -5, 10):
+        fix.heapq.heappush(retry_schedule, now + timedelta(seconds=seconds))
+
+    assert fix.pop_retry_wait_time(retry_schedule) == 0
+    assert 9 < fix.pop_retry_wait_time(retry_schedule) <= 10
+    assert len(retry_schedule) == 1
+
+
+def test_release_fix_data_list():
+    db = _create_fix_list_db(2)
+    fix_data_list_buffer = fix.deque()
+    fix_data_list = fix.get_next_fix_data_list(
+        db, "run-1", fix_data_list_buffer, 2)
+    assert [d["id"] for d in fix_data_list] == [1]
+
+    fix.release_fix_data_list_buffer(db, fix_data_list_buffer)
+    assert [d["id"] for d in fix.claim_fix_data_list(db, "run-1", 2)] == [2]
+
+
+def test_claim_fix_data_list_by_restored_file():
+    db = _create_fix_list_db(5, restored_file_num=2)
+    db[consts.FIX_LIST_TABLENAME].update(
+        {"id": 5, "user_id": 2}, ["id"])
+
+    fix_data_list = fix.claim_fix_data_list(db, "run-1", 1)
+    assert [d["id"] for d in fix_data_list] == [1, 3, 5]
+    assert [[d["id"] for d in group]
+            for group in fix.group_fix_data_list(fix_data_list)] == [[1, 3], [5]]
+    assert [d["id"] for d in fix.claim_fix_data_list(db, "run-1", 1)] == [2, 4]
+
+
+def test_group_db_commands():
+    def _update(fix_id, **kwargs):
+        return {"table_name": "t", "command": "update",
+                "args": [{"id": fix_id, **kwargs}, ["id"]]}
+
+    data_list = [
+        _update(1, working_status=1),
+        _update(2, working_status=2, copy_file_id=2),
+        _update(3, working_status=3),
+        _update(1, working_status=100, copy_file_id=1),
+        {"table_name": "t", "command": "insert", "args": [{"name": "x"}]},
+        _update(4, working_status=4),
+    ]
+    command_groups = fix.group_db_commands(data_list)
+
+    assert [[d["args"][0].get("id") for d in g] for g in command_groups] == [
+        [1, 3], [2], [1], [None], [4]]
+
+
+def test_db_batch_operation():
+    db = _create_fix_list_db(3)
+    db_queue, log_queue = queue.Queue(), queue.Queue()
+
+    fix.change_working_status(db_queue, 1, consts.WorkingStatus.CAN_NOT_COPY)
+    fix.change_working_status(
+        db_queue, 2, consts.WorkingStatus.CAN_NOT_ADD_COLLABORATION)
+    fix.change_working_status_to_complete(db_queue, 3, 10, "owner", 20)
+    fix.change_working_status(
+        db_queue, 3, consts.WorkingStatus.CAN_NOT_REMOVE_COLLABORATION)
+
+    data_list, shutdown = fix.get_db_command_batch(db_queue)
+    assert len(data_list) == 4
+    assert shutdown is False
+
+    fix.db_batch_operation(db, data_list, log_queue)
+    table = db[consts.FIX_LIST_TABLENAME]
+    assert table.find_one(id=1)["working_status"] == \
+        consts.WorkingStatus.CAN_NOT_COPY.value
+    assert table.find_one(id=2)["working_status"] == \
+        consts.WorkingStatus.CAN_NOT_ADD_COLLABORATION.value
+    assert table.find_one(id=3)["working_status"] == \
+        consts.WorkingStatus.CAN_NOT_REMOVE_COLLABORATION.value
+    assert table.find_one(id=3)["copy_file_id"] == 20
+    assert "Database batch committed. size: 4" in log_queue.get_nowait()["msg"]
+
+
+def test_db_batch_operation_if_error_occured():
+    db = _create_fix_list_db(1)
+    log_queue = queue.Queue()
+    data_list = [
+        {"table_name": consts.FIX_LIST_TABLENAME, "command": "update",
+         "args": [{"id": 1, "working_status": 5}, ["id"]]},
+        {"ALLYOURBASEARE": "BELONGTOUS", },
+    ]
+    fix.db_batch_operation(db, data_list, log_queue)
+
+    assert db[consts.FIX_LIST_TABLENAME].find_one(id=1)["working_status"] == 5
+    assert log_queue.get_nowait()["level"] == logging.WARNING
+    assert log_queue.get_nowait()[
+        "msg"] == "Database operation error: 'table_name'"
+
+
+class IndexedBoxFolder:
+    def __init__(self, object_id, name=None, child_folders=None):
+        self.object_id = self.id = object_id
+        self.name = name
+        self.type = "folder"
+        self.child_folders = child_folders or list()
+        self.created_subfolders = list()
+
+    def get_items(self, *args, **kwargs):
+        return self.child_folders
+
+    def create_subfolder(self, name):
+        folder = IndexedBoxFolder(f"new-{name}", name)
+        self.created_subfolders.append(folder)
+        return folder
+
+
+class IndexedBoxClient:
+    translator = Translator()
+    session = None
+
+    def folder(self, folder_id):
+        return IndexedBoxFolder(folder_id)
+
+
+def test_resolve_owner_folder():
+    db = _create_fix_list_db(0)
+    fix.folder_index.clear_cache()
+    log_queue = queue.Queue()
+
+    root_folder = IndexedBoxFolder("1", child_folders=[
+        IndexedBoxFolder("10", "upload@example.com")])
+    fix.build_root_folder_index(log_queue, db, root_folder)
+
+    upload_user_folder = fix.get_or_create_upload_user_folder(
+        "1", log_queue, IndexedBoxClient(), db, [threading.Lock()], "upload@example.com",
+        root_folder)
+    assert upload_user_folder.object_id == "10"
+    assert root_folder.created_subfolders == []
+
+    upload_user_folder.child_folders = [
+        IndexedBoxFolder("20", "owner1@example.com"),
+        IndexedBoxFolder("21", "owner2@example.com")]
+    owner_folder = fix.get_or_create_owner_folder_in_upload_user_folder(
+        "1", log_queue, IndexedBoxClient(), db, [threading.Lock()], root_folder,
+        upload_user_folder,
+        "upload@example.com", "owner2@example.com")
+    assert owner_folder.object_id == "21"
+
+    owner_folder = fix.get_or_create_owner_folder_in_upload_user_folder(
+        "1", log_queue, IndexedBoxClient(), db, [threading.Lock()], root_folder,
+        upload_user_folder,
+        "upload@example.com", "owner3@example.com")
+    assert owner_folder.object_id == "new-owner3@example.com"
+    assert fix.folder_index.get_folder_id(
+        db, "1", "upload@example.com", "owner3@example.com") == "new-owner3@example.com"
+
+
+def test_fix_group_operation_if_owner_folder_not_found(mocker):
+    db = _create_fix_list_db(0)
+    fix.folder_index.clear_cache()
+    fix.folder_index.put_folder_id_list(db, [
+        ("1", "upload@example.com", "", "10"),
+        ("1", "upload@example.com", "folder-owner@example.com", "20"),
+        ("1", "upload@example.com", "other-owner@example.com", "21")])
+    mocker.patch('fixer.modes.fix.add_appuser_collaboration',
+                 return_value=None)
+    mocker.patch('fixer.modes.fix.copy_restored_file',
+                 side_effect=BoxAPIException(404))
+
+    db_queue, log_queue = queue.Queue(), queue.Queue()
+    args = _fix_group_operation_args(db_queue, log_queue)
+    args[-2]["root_folder_id"] = "1"
+    fix.fix_group_operation(*args)
+    db_queue.put(consts.PROCESS_SHUTDOWN_SENTINEL)
+    fix.db_process_func(
+        {"<DATABASE-FILE>": db.url[len("sqlite:///"):]}, db_queue, log_queue)
+
+    # Deleted or moved in Box, so it is resolved again on the retry.
+    assert fix.folder_index.get_folder_id(
+        db, "1", "upload@example.com") is None
+    assert fix.folder_index.get_folder_id(
+        db, "1", "upload@example.com", "folder-owner@example.com") is None
+    assert fix.folder_index.get_folder_id(
+        db, "1", "upload@example.com", "other-owner@example.com") == "21"
+
+
+class ConflictBoxFolder(IndexedBoxFolder):
+    def create_subfolder(self, name):
+        time.sleep(0.01)
+        self.created_subfolders.append(name)
+        if len(self.created_subfolders) > 1:
+            raise BoxAPIException(
+                409, code="item_name_in_use",
+                context_info={"conflicts": [{"type": "folder", "id": "30"}]})
+        return IndexedBoxFolder("30", name)
+
+
+def test_get_or_create_upload_user_folder_single_flight():
+    db_file = tempfile.NamedTemporaryFile(suffix=".db")
+    initialize_db.main({"<DATABASE-FILE>": db_file.name})
+    fix.folder_index.clear_cache()
+    folder_locks = [threading.Lock() for _ in range(4)]
+    root_folder = ConflictBoxFolder("1")
+
+    def resolve():
+        db = utils.get_db({"<DATABASE-FILE>": db_file.name})
+        return fix.get_or_create_upload_user_folder(
+            "1", queue.Queue(), IndexedBoxClient(), db, folder_locks,
+            "upload@example.com", root_folder).object_id
+
+    with ThreadPoolExecutor(8) as executor:
+        result = list(executor.map(lambda _: resolve(), range(8)))
+
+    assert result == ["30"] * 8
+    assert root_folder.created_subfolders == ["upload@example.com"]
+
+
+def test_create_subfolder_or_get_existing():
+    root_folder = ConflictBoxFolder("1")
+    root_folder.created_subfolders.append("other@example.com")
+    folder = fix.create_subfolder_or_get_existing(
+        IndexedBoxClient(), root_folder, "upload@example.com")
+    assert folder.object_id == "30"
+
+    assert fix.get_folder_lock([1, 2, 3], "1", "upload@example.com") == \
+        fix.get_folder_lock([1, 2, 3], "1", "upload@example.com")
+
+
+class FakeTokenManager:
+    def __init__(self, failure_num=0):
+        self.in_flight = 0
+        self.failure_num = failure_num
+
+    def acquire(self):
+        if self.failure_num:
+            self.failure_num -= 1
+            raise Exception("No appuser access token is available.")
+        self.in_flight += 1
+        return "test-access-token", 1
+
+    def release(self, box_user_id):
+        self.in_flight -= 1
+
+
+def _run_fix_pipeline(db, stage_concurrency, token_manager=None):
+    opt = {
+        "<DATABASE-FILE>": db.url[len("sqlite:///"):],
+        "<JWT-FILE>": "./test_assets/test-jwt-file.json",
+        "<BOX-FOLDER-ID>": "1",
+        "--concurrency": 2,
+        "--stage-concurrency": stage_concurrency,
+    }
+    db_queue, log_queue = queue.Queue(), queue.Queue()
+    token_manager = token_manager or FakeTokenManager()
+    fix.asyncio.run(fix.FixPipeline(
+        "1", opt, multiprocessing.Event(), db_queue, log_queue, "run-1",
+        [{"box_user_id": 1}], [threading.Lock()], token_manager).run())
+
+    assert token_manager.in_flight == 0
+    return list(db_queue.queue), [data["msg"] for data in log_queue.queue]
+
+
+def _mock_fix_steps(mocker):
+    mocker.patch('fixer.modes.fix.utils.get_service_client', return_value=None)
+    mocker.patch('fixer.modes.fix.resolve_owner_folder',
+                 return_value=BoxFolder())
+    mocker.patch('fixer.modes.fix.add_appuser_collaboration',
+                 return_value="300")
+    mocker.patch('fixer.modes.fix.copy_restored_file',
+                 return_value=BoxFile())
+    mocker.patch('fixer.modes.fix.remove_appuser_collaborations',
+                 return_value=None)
+
+
+def test_fix_pipeline(mocker):
+    _mock_fix_steps(mocker)
+    db = _create_fix_list_db(20)
+
+    db_command_list, log_list = _run_fix_pipeline(db, "copy=5,record=2")
+
+    complete_id_list = [
+        data["args"][0]["id"] for data in db_command_list
+        if data["args"][0].get("working_status") == consts.WorkingStatus.COMPLETE.value]
+    assert sorted(complete_id_list) == list(range(1, 20 + 1))
+    assert len(db_command_list) == 60
+    assert any(msg.startswith("[Process-1] Pipeline max queue depth: resolve=")
+               for msg in log_list)
+
+
+def test_fix_pipeline_if_restored_file_is_shared(mocker):
+    _mock_fix_steps(mocker)
+    add_appuser_collaboration = mocker.patch(
+        'fixer.modes.fix.add_appuser_collaboration', return_value="300")
+    db = _create_fix_list_db(12, restored_file_num=4)
+
+    db_command_list, _ = _run_fix_pipeline(db, "copy=2")
+
+    assert add_appuser_collaboration.call_count == 4
+    assert fix.remove_appuser_collaborations.call_count == 4
+    complete_id_list = [
+        data["args"][0]["id"] for data in db_command_list
+        if data["args"][0].get("working_status") == consts.WorkingStatus.COMPLETE.value]
+    assert sorted(complete_id_list) == list(range(1, 12 + 1))
+
+
+def test_fix_pipeline_if_token_is_not_available(mocker):
+    _mock_fix_steps(mocker)
+    mocker.patch("consts.ACCESS_TOKEN_RETRY_WAIT_TIME", 0)
+    db = _create_fix_list_db(4)
+
+    # The groups are put back and fixed once a token is available.
+    db_command_list, log_list = _run_fix_pipeline(
+        db, None, FakeTokenManager(failure_num=3))
+
+    complete_id_list = [
+        data["args"][0]["id"] for data in db_command_list
+        if data["args"][0].get("working_status") == consts.WorkingStatus.COMPLETE.value]
+    assert sorted(complete_id_list) == [1, 2, 3, 4]
+    assert sum("Can't create box client!" in msg for msg in log_list) == 3
+
+
+def test_fix_pipeline_if_step_failed(mocker):
+    _mock_fix_steps(mocker)
+    mocker.patch('fixer.modes.fix.copy_restored_file',
+                 side_effect=Exception('testException'))
+    db = _create_fix_list_db(2)
+    db[consts.FIX_LIST_TABLENAME].update(
+        {"id": 1, "copy_attempt_count": consts.FIX_PROCESS_RETRY_COUNT - 1}, ["id"])
+    db[consts.FIX_LIST_TABLENAME].update(
+        {"id": 2, "copy_attempt_count": consts.FIX_PROCESS_RETRY_COUNT - 1}, ["id"])
+
+    db_command_list, _ = _run_fix_pipeline(db, None)
+
+    status_list = [data["args"][0]["working_status"] for data in db_command_list
+                   if "working_status" in data["args"][0]]
+    assert sorted(status_list) == [consts.WorkingStatus.CAN_NOT_COPY.value] * 2 + \
+        [consts.WorkingStatus.COLLABORATED.value] * 2
@@ -0,0 +1,51 @@
+import sys
+from collections import OrderedDict
+from datetime import datetime
+
+import pytest
+from fixer import consts
+from fixer.fix_item import FixItem
+
+
+def _create_row():
+    now = datetime.now()
+    return OrderedDict({
+        "id": 1,
+        "restored_file_id": 10,
+        "file_name": "test_file",
+        "original_file_id": 11,
+        "original_path_names": "/original/file/path",
+        "original_folder_name": "Original Folder Name",
+        "user_id": 100,
+        "login": "folder-owner@example.com",
+        "upload_user_id": 200,
+        "uploader_email": "upload@example.com",
+        "working_status": consts.WorkingStatus.COLLABORATED.value,
+        "copy_file_id": None,
+        "copy_folder_id": None,
+        "copy_folder_name": None,
+        "lease_owner": "0123456789abcdef",
+        "lease_run_id": "0123456789abcdef",
+        "lease_expires_at": now,
+        "collaboration_id": "300",
+        "collaborate_attempt_count": None,
+        "copy_attempt_count": 2,
+        "remove_collaboration_attempt_count": None,
+        "next_attempt_at": None,
+        "created_at": now,
+        "updated_at": now,
+    })
+
+
+def test_fix_item():
+    fix_data = FixItem.from_row(_create_row())
+
+    assert fix_data["login"] == "folder-owner@example.com"
+    assert fix_data.get("collaboration_id") == "300"
+    assert fix_data.get("copy_file_id") is None
+    assert fix_data.get("copy_attempt_count") == 2
+    assert fix_data.get("next_attempt_at") is None
+    with pytest.raises(KeyError):
+        fix_data["created_at"]
+    assert not hasattr(fix_data, "__dict__")
+    assert sys.getsizeof(fix_data) < sys.getsizeof(_create_row())
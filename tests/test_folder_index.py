@@ -0,0 +1,59 @@
+import tempfile
+import uuid
+from pathlib import Path
+
+from fixer import consts, folder_index, utils
+from fixer.modes import initialize_db
+
+
+def _get_initialized_db():
+    db_filename = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.db')
+    opt = {"<DATABASE-FILE>": db_filename}
+    initialize_db.main(opt)
+    return opt, utils.get_db(opt)
+
+
+def test_put_and_get_folder_id():
+    folder_index.clear_cache()
+    _, db = _get_initialized_db()
+
+    assert folder_index.get_folder_id(db, 1, "upload@example.com") is None
+    assert not folder_index.has_root_folder(db, 1)
+
+    folder_index.put_folder_id(db, 1, "upload@example.com", "", 10)
+    folder_index.put_folder_id_list(db, [
+        (1, "upload@example.com", "owner1@example.com", 11),
+        (1, "upload@example.com", "owner2@example.com", 12),
+    ])
+
+    assert folder_index.has_root_folder(db, 1)
+    assert folder_index.get_folder_id(db, 1, "upload@example.com") == "10"
+    assert folder_index.get_folder_id(
+        db, "1", "upload@example.com", "owner2@example.com") == "12"
+    assert folder_index.get_folder_id(
+        db, 2, "upload@example.com", "owner2@example.com") is None
+
+
+def test_get_folder_id_from_other_process():
+    folder_index.clear_cache()
+    opt, db = _get_initialized_db()
+
+    # Written through another connection, e.g. by another fixer process.
+    other_db = utils.get_db(opt)
+    folder_index.put_folder_id(
+        other_db, 1, "upload@example.com", "owner@example.com", 20)
+    folder_index.clear_cache()
+
+    assert folder_index.get_folder_id(
+        db, 1, "upload@example.com", "owner@example.com") == "20"
+    assert db[consts.FOLDER_INDEX_TABLENAME].count() == 1
+
+
+def test_put_folder_id_if_already_exists():
+    folder_index.clear_cache()
+    _, db = _get_initialized_db()
+
+    folder_index.put_folder_id(db, 1, "upload@example.com", "", 10)
+    folder_index.put_folder_id(db, 1, "upload@example.com", "", 10)
+    assert db[consts.FOLDER_INDEX_TABLENAME].count() == 1
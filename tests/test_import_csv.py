@@ -1,5 +1,10 @@
+import bz2
 import csv
+import gzip
+import io
+import lzma
 import tempfile
+import time
 import uuid
 from pathlib import Path
 
@@ -67,3 +72,257 @@ def test_import_corrupted_header_csv(capsys, mocker):
            "<CSV-FILE>": "./test_assets/test_corrupted_header.csv"}
     with pytest.raises(SystemExit) as pytest_wrapped_e:
         import_csv.main(opt)
+
+
+def _write_csv(row_num, duplicate_every=None, **values):
+    with open("./test_assets/test.csv", "r") as fh:
+        reader = csv.DictReader(fh)
+        fieldnames = reader.fieldnames
+        template = next(reader)
+
+    csv_file = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.csv')
+    with open(csv_file, "w", newline="") as fh:
+        writer = csv.DictWriter(fh, fieldnames=fieldnames)
+        writer.writeheader()
+        for i in range(row_num):
+            key = i - 1 if duplicate_every and i % duplicate_every == duplicate_every - 1 else i
+            writer.writerow(
+                {**template, "restored_file_id": 10000 + key, **values})
+    return csv_file
+
+
+def test_import_csv_in_chunks(capsys, mocker):
+    mocker.patch("consts.IMPORT_CSV_CHUNK_SIZE", 7)
+    db_filename = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.db')
+    opt = {"<DATABASE-FILE>": db_filename}
+    initialize_db.main(opt)
+
+    opt["<CSV-FILE>"] = _write_csv(50, duplicate_every=10)
+    import_csv.main(opt)
+    captured = capsys.readouterr()
+    assert captured.err.count("Data already exists in db.") == 5
+
+    # Keys already in the db are reported too.
+    opt["<CSV-FILE>"] = _write_csv(3)
+    import_csv.main(opt)
+    captured = capsys.readouterr()
+    assert captured.err.count("Data already exists in db.") == 3
+
+    db = utils.get_db(opt)
+    assert db[consts.FIX_LIST_TABLENAME].count() == 53
+
+
+def test_import_csv_if_rows_are_many(capsys):
+    db_filename = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.db')
+    opt = {"<DATABASE-FILE>": db_filename}
+    initialize_db.main(opt)
+
+    opt["<CSV-FILE>"] = _write_csv(50000)
+    start = time.perf_counter()
+    import_csv.main(opt)
+    assert time.perf_counter() - start < 10
+
+    db = utils.get_db(opt)
+    assert db[consts.FIX_LIST_TABLENAME].count() == 50000
+
+
+def test_find_record_boundaries():
+    data = b'h1,h2\n"a\nb",1\n"c""\nd",2\n"e",3\n'
+    csv_file = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.csv')
+    csv_file.write_bytes(data)
+
+    with open(csv_file, "rb") as fh:
+        boundaries = import_csv.find_record_boundaries(fh, 6, len(data), 8)
+    # Only ends of records, never the newlines inside quoted fields.
+    assert boundaries == [6, 14, 24, len(data)]
+
+
+def test_import_csv_with_workers(capsys, mocker):
+    mocker.patch("consts.IMPORT_CSV_PARSE_CHUNK_BYTES", 1000)
+    # Quoted newlines must not split a record.
+    csv_file = _write_csv(500, duplicate_every=100,
+                          path_names='path\n"names"')
+
+    def _import(workers):
+        db_filename = Path(tempfile.gettempdir()) / \
+            Path(f'test-{uuid.uuid4().hex[0:8]}.db')
+        opt = {"<DATABASE-FILE>": db_filename}
+        initialize_db.main(opt)
+        opt.update({"<CSV-FILE>": csv_file, "--workers": workers})
+        import_csv.main(opt)
+
+        db = utils.get_db(opt)
+        return [(row["restored_file_id"], row["original_path_names"])
+                for row in db[consts.FIX_LIST_TABLENAME].all(order_by="id")]
+
+    expected = _import("1")
+    expected_err = capsys.readouterr().err
+    assert _import("3") == expected
+    captured = capsys.readouterr()
+    assert captured.err == expected_err
+    assert captured.out.startswith("Imported 500 rows in ")
+    assert len(expected) == 500
+    assert expected[0][1] == 'path\n"names"'
+
+
+def test_import_csv_with_workers_if_line_is_incorrect(mocker):
+    mocker.patch("consts.IMPORT_CSV_PARSE_CHUNK_BYTES", 1000)
+    csv_file = _write_csv(100)
+    with open(csv_file, "a") as fh:
+        fh.write('"1","file_name"\n')
+
+    db_filename = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.db')
+    opt = {"<DATABASE-FILE>": db_filename}
+    initialize_db.main(opt)
+    opt.update({"<CSV-FILE>": csv_file, "--workers": "2"})
+    with pytest.raises(SystemExit):
+        import_csv.main(opt)
+
+    db = utils.get_db(opt)
+    assert db[consts.FIX_LIST_TABLENAME].count() == 0
+
+
+def test_import_csv_if_compressed(capsys):
+    csv_file = _write_csv(100, path_names='path\n"names"')
+    for compression in (gzip, bz2, lzma):
+        db_filename = Path(tempfile.gettempdir()) / \
+            Path(f'test-{uuid.uuid4().hex[0:8]}.db')
+        opt = {"<DATABASE-FILE>": db_filename}
+        initialize_db.main(opt)
+
+        # Found by the content, not by the file name.
+        compressed_file = csv_file.with_name(f'test-{uuid.uuid4().hex[0:8]}.csv')
+        compressed_file.write_bytes(compression.compress(csv_file.read_bytes()))
+        opt.update({"<CSV-FILE>": compressed_file, "--workers": "2"})
+        import_csv.main(opt)
+        captured = capsys.readouterr()
+        assert captured.out.startswith("Imported 100 rows in ")
+        assert "--workers is ignored" in captured.err
+
+        db = utils.get_db(opt)
+        assert db[consts.FIX_LIST_TABLENAME].count() == 100
+        assert db[consts.FIX_LIST_TABLENAME].find_one()[
+            "original_path_names"] == 'path\n"names"'
+
+
+def test_import_csv_from_stdin(capsys, mocker):
+    csv_file = _write_csv(100)
+    for data in (csv_file.read_bytes(), gzip.compress(csv_file.read_bytes())):
+        db_filename = Path(tempfile.gettempdir()) / \
+            Path(f'test-{uuid.uuid4().hex[0:8]}.db')
+        opt = {"<DATABASE-FILE>": db_filename}
+        initialize_db.main(opt)
+
+        stdin = mocker.patch("sys.stdin")
+        stdin.buffer = io.BufferedReader(io.BytesIO(data))
+        opt["<CSV-FILE>"] = "-"
+        import_csv.main(opt)
+        assert not stdin.buffer.closed
+
+        db = utils.get_db(opt)
+        assert db[consts.FIX_LIST_TABLENAME].count() == 100
+
+
+def test_import_csv_incrementally(capsys, mocker):
+    db_filename = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.db')
+    opt = {"<DATABASE-FILE>": db_filename}
+    initialize_db.main(opt)
+
+    data = _write_csv(150, path_names='path\n"names"').read_bytes()
+    first = _write_csv(100, path_names='path\n"names"').read_bytes()
+    # Cut inside the quoted field of the last record.
+    cut = data.rfind(b'path\n') + len(b'path\n')
+    csv_file = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.csv')
+    csv_file.write_bytes(first)
+    opt["<CSV-FILE>"] = csv_file
+    import_csv.main(opt)
+    capsys.readouterr()
+
+    read_csv_data_in_chunks = mocker.spy(import_csv, "read_csv_data_in_chunks")
+    for appended, row_num in ((data[len(first):cut], 49), (data[cut:], 1), (b"", 0)):
+        with open(csv_file, "ab") as fh:
+            fh.write(appended)
+        import_csv.main(opt)
+        captured = capsys.readouterr()
+        assert "Data already exists in db." not in captured.err
+        assert captured.out.startswith(f"Imported {row_num} rows in ")
+
+    assert read_csv_data_in_chunks.call_args_list[0].args[1] == len(first)
+    db = utils.get_db(opt)
+    assert db[consts.FIX_LIST_TABLENAME].count() == 150
+    assert db[consts.FIX_LIST_TABLENAME].find_one(restored_file_id=10149)[
+        "original_path_names"] == 'path\n"names"'
+    state = db[consts.IMPORT_CSV_STATE_TABLENAME].find_one()
+    assert state["byte_offset"] == len(data)
+    assert state["row_count"] == 150
+
+
+def test_import_csv_incrementally_if_file_is_rewritten(capsys):
+    db_filename = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.db')
+    opt = {"<DATABASE-FILE>": db_filename}
+    initialize_db.main(opt)
+
+    csv_file = _write_csv(10)
+    opt["<CSV-FILE>"] = csv_file
+    import_csv.main(opt)
+    capsys.readouterr()
+
+    # Same path and file, other content.
+    csv_file.write_bytes(_write_csv(10, file_name="other_file").read_bytes())
+    import_csv.main(opt)
+    captured = capsys.readouterr()
+    assert "<CSV-FILE> has changed since the last import" in captured.err
+    assert captured.err.count("Data already exists in db.") == 10
+    assert captured.out.startswith("Imported 10 rows in ")
+
+
+def test_import_csv_if_last_line_has_no_newline(capsys):
+    csv_file = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.csv')
+    csv_file.write_bytes(Path("./test_assets/test.csv").read_bytes().rstrip(b"\r\n"))
+
+    db_filename = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.db')
+    opt = {"<DATABASE-FILE>": db_filename, "<CSV-FILE>": csv_file}
+    initialize_db.main(opt)
+    import_csv.main(opt)
+    captured = capsys.readouterr()
+    assert captured.out.startswith("Imported 600 rows in ")
+
+    db = utils.get_db(opt)
+    assert db[consts.FIX_LIST_TABLENAME].count() == 600
+    assert db[consts.IMPORT_CSV_STATE_TABLENAME].find_one()[
+        "byte_offset"] == csv_file.stat().st_size
+
+
+def test_import_csv_incrementally_if_file_was_empty(capsys):
+    db_filename = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.db')
+    opt = {"<DATABASE-FILE>": db_filename}
+    initialize_db.main(opt)
+
+    data = _write_csv(3).read_bytes()
+    csv_file = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.csv')
+    csv_file.write_bytes(b"")
+    opt["<CSV-FILE>"] = csv_file
+    import_csv.main(opt)
+    assert capsys.readouterr().out.startswith("Imported 0 rows in ")
+
+    # The header is not taken for a row.
+    csv_file.write_bytes(data)
+    import_csv.main(opt)
+    assert capsys.readouterr().out.startswith("Imported 3 rows in ")
+
+    db = utils.get_db(opt)
+    assert db[consts.FIX_LIST_TABLENAME].count() == 3
+    assert db[consts.FIX_LIST_TABLENAME].count(
+        restored_file_id="restored_file_id") == 0
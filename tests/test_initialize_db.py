@@ -1,5 +1,5 @@
 from fixer.modes import initialize_db
-from fixer import consts, utils
+from fixer import consts, folder_index, utils
 import pytest
 from pathlib import Path
 import uuid
@@ -20,6 +20,43 @@ def test_initialize_db_if_success():
         for column_name in schema['columns'].keys():
             assert table.has_column(column_name)
 
+        index_name_list = [index["name"]
+                           for index in db.inspect.get_indexes(table_name)]
+        for index_name in schema.get('indexes', {}):
+            assert index_name in index_name_list
+
+
+def test_initialize_db_if_index_is_not_unique(capsys):
+    db_filename = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.db')
+    opt = {"<DATABASE-FILE>": db_filename}
+    initialize_db.main(opt)
+
+    # A DB file from before the index was unique, with a duplicate key.
+    db = utils.get_db(opt)
+    db.query('DROP INDEX ix_folder_index_key')
+    db.query('CREATE INDEX ix_folder_index_key ON "FOLDER_INDEX" '
+             '(root_folder_id, uploader_email, owner_login)')
+    table = db[consts.FOLDER_INDEX_TABLENAME]
+    for folder_id in ("10", "11"):
+        table.insert({"root_folder_id": "1", "uploader_email": "upload@example.com",
+                      "owner_login": "", "folder_id": folder_id})
+    assert False == utils.check_db_table_and_column(db)
+    assert "'ix_folder_index_key' index is not up to date" in capsys.readouterr().err
+    utils.close_db(db)
+
+    initialize_db.main(opt)
+    db = utils.get_db(opt)
+    assert True == utils.check_db_table_and_column(db)
+    table = db[consts.FOLDER_INDEX_TABLENAME]
+    assert [row["folder_id"] for row in table.all()] == ["11"]
+
+    folder_index.put_folder_id_list(db, [
+        ("1", "upload@example.com", "", "12"),
+        ("1", "upload@example.com", "owner@example.com", "20")])
+    folder_index.put_folder_id(db, "1", "upload@example.com", "", "13")
+    assert sorted(row["folder_id"] for row in table.all()) == ["13", "20"]
+
 
 def test_initialize_db_if_success_if_error(mocker):
     mocker.patch('fixer.modes.initialize_db._initialize_db',
@@ -0,0 +1,76 @@
+import multiprocessing
+import time
+
+import requests
+from boxsdk.exception import BoxAPIException
+from fixer import rate_limiter, utils
+
+
+def test_rate_limiter():
+    limiter = rate_limiter.RateLimiter(rate=50, burst=5)
+
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+    assert time.monotonic() - start < 0.05
+
+    for _ in range(5):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.08
+
+
+def test_rate_limiter_block():
+    limiter = rate_limiter.RateLimiter(rate=1000, burst=10, stripes=8)
+    limiter.block("user-a", 0.2)
+
+    start = time.monotonic()
+    limiter.acquire("user-b")
+    assert time.monotonic() - start < 0.1
+
+    limiter.acquire("user-a")
+    assert time.monotonic() - start >= 0.2
+
+
+def _acquire_in_child(limiter):
+    for _ in range(5):
+        limiter.acquire()
+
+
+def test_rate_limiter_is_shared_between_processes():
+    limiter = rate_limiter.RateLimiter(rate=10, burst=5)
+
+    process = multiprocessing.Process(
+        target=_acquire_in_child, args=(limiter,))
+    process.start()
+    process.join()
+
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.05
+
+
+def test_get_retry_after():
+    e = BoxAPIException(429, headers={"Retry-After": "7"})
+    assert rate_limiter.get_retry_after(e) == 7
+
+    e = BoxAPIException(500, headers={})
+    assert rate_limiter.get_retry_after(e, 3) == 3
+    assert rate_limiter.get_retry_after(Exception(), 3) == 3
+
+
+def test_pooled_network_honors_retry_after(mocker):
+    acquire = mocker.patch.object(utils.rate_limiter, "acquire")
+    block = mocker.patch.object(utils.rate_limiter, "block")
+
+    response = requests.Response()
+    response.status_code = 429
+    response.headers["Retry-After"] = "5"
+    response._content = b""
+    response.request = requests.Request(
+        "GET", "https://api.box.com/2.0/users/me").prepare()
+    network = utils.PooledNetwork(1)
+    mocker.patch.object(network._session, "request", return_value=response)
+
+    network.request("GET", "https://api.box.com/2.0/users/me", "token")
+    acquire.assert_called_once_with("token")
+    block.assert_called_once_with("token", 5)
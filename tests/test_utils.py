@@ -7,6 +7,8 @@ from pathlib import Path
 
 import dataset
 from boxsdk import Client
+from boxsdk.object.user import User
+from boxsdk.exception import BoxAPIException
 from fixer import consts, fixer, utils
 from fixer.modes import initialize_db
 
@@ -61,6 +63,29 @@ def test_check_table_and_column_if_correct(capsys):
     assert True == utils.check_db_table_and_column(db)
 
 
+def test_check_table_and_column_if_index_is_missing(capsys):
+    db_filename = Path(tempfile.gettempdir()) / \
+        Path(f'test-{uuid.uuid4().hex[0:8]}.db')
+    opt = {
+        '<DATABASE-FILE>': db_filename,
+    }
+    initialize_db._initialize_db(opt)
+
+    db = utils.get_db(opt)
+    db.query('DROP INDEX ix_fix_list_unfinished')
+    assert False == utils.check_db_table_and_column(db)
+    captured = capsys.readouterr()
+    assert captured.err == (
+        "Error: FIX_LIST table does not have 'ix_fix_list_unfinished' index. "
+        "Run initialize-db to add it.\n")
+    utils.close_db(db)
+
+    # Upgrade by running initialize-db again.
+    initialize_db._initialize_db(opt)
+    db = utils.get_db(opt)
+    assert True == utils.check_db_table_and_column(db)
+
+
 def test_check_table_and_column_if_incorrect(capsys):
     db_filename = Path(tempfile.gettempdir()) / \
         Path(f'test-{uuid.uuid4().hex[0:8]}.db')
@@ -103,3 +128,126 @@ def test_get_client():
 
 def test_get_client_with_access_token():
     assert isinstance(utils.get_client_with_access_token("test-access-token"), Client)
+
+
+def test_get_appuser_client():
+    client = utils.get_appuser_client(1, "test-access-token")
+    assert isinstance(client, Client)
+    assert utils.get_appuser_client(1, "test-access-token") is client
+
+    # Replaced only when the access token has been rotated.
+    rotated_client = utils.get_appuser_client(1, "rotated-access-token")
+    assert rotated_client is not client
+    assert utils.get_appuser_client(2, "test-access-token") is not client
+
+
+def test_get_service_client(mocker):
+    opt = {"<JWT-FILE>": "./test_assets/test-jwt-file.json"}
+    get_auth = mocker.spy(utils, "get_auth")
+
+    client = utils.get_service_client(opt)
+    assert utils.get_service_client(opt) is client
+    assert get_auth.call_count <= 1
+
+
+def test_init_network():
+    network = utils.init_network(32)
+    assert utils.get_network() is network
+
+    client = utils.get_client_with_access_token("test-access-token")
+    assert client.session._network_layer is network
+
+    adapter = network._session.get_adapter("https://api.box.com")
+    assert adapter._pool_maxsize == 32
+
+
+def test_ttl_cache():
+    cache = utils.TTLCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+
+    # "b" is the least recently used entry.
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert len(cache) == 2
+    assert cache.pop("a") == 1
+    assert cache.get("a", "default") == "default"
+
+
+def test_ttl_cache_if_expired(mocker):
+    cache = utils.TTLCache(2, ttl=10)
+    mocker.patch("fixer.utils.time.monotonic", return_value=100)
+    cache.set("a", 1)
+
+    mocker.patch("fixer.utils.time.monotonic", return_value=110)
+    assert cache.get("a") == 1
+    mocker.patch("fixer.utils.time.monotonic", return_value=111)
+    assert cache.get("a") is None
+
+
+def test_get_user(mocker):
+    user_get = mocker.patch("boxsdk.object.user.User.get",
+                            side_effect=lambda *args, **kwargs: User(None, "2"))
+    client = utils.get_client_with_access_token("test-access-token")
+    saved_calls = utils.user_cache_stats["saved_calls"]
+
+    # lazy reference
+    assert utils.get_user(client, 1).object_id == 1
+    assert user_get.call_count == 0
+
+    user = utils.get_user(client, 2, fetch=True)
+    assert utils.get_user(client, 2, fetch=True).object_id == user.object_id
+    assert user_get.call_count == 1
+    assert utils.user_cache_stats["saved_calls"] == saved_calls + 1
+
+    # Shared across clients, e.g. after an access token has been rotated.
+    other_client = utils.get_client_with_access_token("rotated-access-token")
+    other_user = utils.get_user(other_client, 2, fetch=True)
+    assert other_user.session is other_client.session
+    assert user_get.call_count == 1
+    assert utils.user_cache_stats["saved_calls"] == saved_calls + 2
+
+
+def test_get_folder_items(mocker):
+    client = utils.get_client_with_access_token("test-access-token")
+    request = mocker.patch.object(client.session, "get", return_value=mocker.Mock(
+        json=lambda: {"entries": [{"type": "folder", "id": "10", "name": "upload@example.com"}],
+                      "total_count": 1, "offset": 0, "limit": 1000}))
+
+    item_list = list(utils.get_folder_items(client.folder("1")))
+    assert [item.name for item in item_list] == ["upload@example.com"]
+    params = request.call_args.kwargs["params"]
+    assert params["limit"] == consts.BOX_LIST_LIMIT
+    assert params["fields"] == "id,name,type"
+
+
+def test_get_conflict(mocker):
+    file_get = mocker.patch("boxsdk.object.file.File.get")
+    client = utils.get_client_with_access_token("test-access-token")
+
+    e = BoxAPIException(409, context_info={"conflicts": {
+        "type": "file", "id": "20", "name": "test_file", "etag": "1"}})
+    conflict = utils.get_conflict(client, e)
+    assert conflict.type == "file"
+    assert conflict.object_id == "20"
+    assert conflict.name == "test_file"
+    assert file_get.call_count == 0
+
+    utils.get_conflict(client, e, fetch=True)
+    assert file_get.call_count == 1
+
+    e = BoxAPIException(409, context_info={"conflicts": [
+        {"type": "folder", "id": "30", "name": "upload@example.com"}]})
+    assert utils.get_conflict(client, e).object_id == "30"
+
+
+def test_get_stage_concurrency():
+    opt = {"--concurrency": "4", "--stage-concurrency": "copy=8,record=2"}
+    assert utils.get_stage_concurrency(opt) == {
+        "resolve": 4,
+        "collaborate": 4,
+        "copy": 8,
+        "remove_collaboration": 4,
+        "record": 2,
+    }
@@ -53,6 +53,8 @@ def test_check_csv_file_exist(capsys):
     # corret
     opt = {"<CSV-FILE>": __file__}
     validators.check_csv_file_exist(opt)
+    opt = {"<CSV-FILE>": "-"}
+    validators.check_csv_file_exist(opt)
 
     # incorrect
     with pytest.raises(SystemExit) as pytest_wrapped_e:
@@ -89,6 +91,59 @@ def test_check_process_num(capsys):
     assert captured.err == "--process must be numeric.\n"
 
 
+def test_check_engine(capsys):
+    for engine in ("process", "async"):
+        opt = {"--engine": engine}
+        validators.check_engine(opt)
+
+    with pytest.raises(SystemExit) as pytest_wrapped_e:
+        opt = {"--engine": "thread"}
+        validators.check_engine(opt)
+
+    captured = capsys.readouterr()
+    assert captured.err == "--engine must be one of process, async.\n"
+
+
+def test_check_concurrency(capsys):
+    opt = {"--concurrency": 100}
+    validators.check_concurrency(opt)
+
+    for concurrency in ("it-is-not-number", 0, 101):
+        with pytest.raises(SystemExit) as pytest_wrapped_e:
+            opt = {"--concurrency": concurrency}
+            validators.check_concurrency(opt)
+
+        captured = capsys.readouterr()
+        assert captured.err == "--concurrency must be a number from 1 to 100.\n"
+
+
+def test_check_stage_concurrency(capsys):
+    for stage_concurrency in (None, "copy=20", "copy=20, collaborate=5"):
+        opt = {"--concurrency": 10, "--stage-concurrency": stage_concurrency}
+        validators.check_stage_concurrency(opt)
+
+    for stage_concurrency in ("copy", "upload=2", "copy=0", "copy=101", "copy=it-is-not-number"):
+        with pytest.raises(SystemExit) as pytest_wrapped_e:
+            opt = {"--concurrency": 10, "--stage-concurrency": stage_concurrency}
+            validators.check_stage_concurrency(opt)
+
+        captured = capsys.readouterr()
+        assert captured.err.startswith("--stage-concurrency must be like")
+
+
+def test_check_workers(capsys):
+    opt = {"--workers": "4"}
+    validators.check_workers(opt)
+
+    for workers in ("it-is-not-number", 0):
+        with pytest.raises(SystemExit) as pytest_wrapped_e:
+            opt = {"--workers": workers}
+            validators.check_workers(opt)
+
+        captured = capsys.readouterr()
+        assert captured.err == "--workers must be a positive number.\n"
+
+
 def test_check_create_appuser_num(capsys):
     opt = {"--create-appuser-num": 32}
     validators.check_create_appuser_num(opt)
@@ -212,6 +267,11 @@ def test_validate_option(capsys, mocker):
         '--box-file-url': "https://app.box.com/file/",
         '--create-appuser-num': 1,
         '--process': 1,
+        '--engine': 'process',
+        '--concurrency': 10,
+        '--stage-concurrency': None,
+        '--copy-first': False,
+        '--workers': 1,
         '--skip-collaboration': True,
         '--skip-put-csv': True,
         '--cert': None,